@@ -15,6 +15,7 @@ import datetime
 import sync
 import helpers
 import data
+import metrics
 
 _logger = logging.getLogger(__name__)
 
@@ -101,8 +102,9 @@ def save_configuration():
 
 	# Write this configuration
 	file_name = _data_dir + '/' +helpers.now().strftime( DATA_DIR_STRFTIME)
-	with open(file_name, 'w') as f:
-		f.write( helpers.dump_json( snapshot))
+	with metrics.Timer( 'lighthouse_snapshot_duration_seconds'):
+		with open(file_name, 'w') as f:
+			f.write( helpers.dump_json( snapshot))
 	return True
 
 
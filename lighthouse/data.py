@@ -6,7 +6,13 @@ We keep two instances of data. One represents currect state and is immutable.
 The other one represents the next state of the data store, being modified by a
 client holding a lock.
 
-This data store is protected by a lock to avoid race conditions.
+Data trees are never modified in place. A change copies the dictionaries and
+lists on the path to the changed entry and shares all other entries with the
+previous version, so versions are cheap to create and to keep.
+
+Modifications of the data store are protected by a lock to avoid race
+conditions. Readers do not take the lock. The current state is replaced by
+a single reference assignment, so readers always see a complete version.
 
 Data can be immediately update asynchronously via push operation.
 
@@ -18,20 +24,42 @@ import logging
 import md5
 import threading
 import time
-import copy
+import collections
+import sys
 
 # Local imports
+import _json as json
 import helpers
+import metrics
 
 # Lock error messages
 LCK_OK = 0 # All OK
 LCK_NONE = 1 # No lock or lock expired
 LCK_CONCURRENT = 2 # Concurrent modification
 
+# Transaction error messages
+TRX_OK = 0 # All OK
+TRX_LOCKED = 1 # Lock is held by a client
+TRX_CONFLICT = 2 # Base version differs or concurrent modification
+TRX_FAILED = 3 # Some operation cannot be applied
+
+# Lock code used by transactions
+TRX_LOCK_CODE = '\0transaction'
+
 
 # Lock timeout in milliseconds
 LOCK_TIMEOUT = 30000
 
+# Maximal number of paths in the path index of a version
+INDEX_SIZE = 65536
+
+# Maximal number of recent versions kept in memory
+HISTORY_SIZE = 16
+# Maximal estimated size of recent versions kept in memory in bytes
+HISTORY_BYTES = 16*1024*1024
+# Estimated memory taken by a node of the data and hash trees in bytes
+NODE_BYTES = 200
+
 # Logging
 _logger = logging.getLogger(__name__)
 
@@ -41,12 +69,9 @@ _lock_code = None
 _lock_timestamp = 0
 
 # Threading lock object(s)
-# FIXME: Locking can be more optimised, eg. different locks for 
-#        different kinds of data.
-#        Some data mnipulations can be made out of the critical
-#        sections.
-_lock = threading.RLock() # reentrant lock, read/write lock would be more handy,
-                          # but python std lib doesn't support such locks
+# Only writers and update sessions take the lock. Current data are immutable
+# and readers access them through a snapshot reference without locking.
+_lock = threading.RLock() # reentrant lock
 
 
 class DataVersion:
@@ -84,35 +109,184 @@ class DataVersion:
 		return DataVersion( sequence=self.sequence, checksum=self.checksum)
 
 
+#
+# Hash tree
+#
+# Every node of the data tree has its digest. Digest of a dictionary or a list
+# is calculated from digests of its children, so the digest of the root covers
+# the whole data store. Digests are kept in a separate tree of (digest,
+# children) tuples mirroring the data tree. Children are a dictionary for
+# dictionaries, a list for lists and None for leaves.
+#
+# Hash tree nodes are never modified. A change replaces nodes on the path to
+# the root only, other nodes are shared between versions.
+#
+
+def _leaf_digest( value):
+	return md5.new( 's' +json.dumps( value)).hexdigest()
+
+def _dict_digest( children):
+	m = md5.new( 'd')
+	for key in sorted( children):
+		m.update( json.dumps( key))
+		m.update( children[ key][0])
+	return m.hexdigest()
+
+def _list_digest( children):
+	m = md5.new( 'l')
+	for child in children:
+		m.update( child[0])
+	return m.hexdigest()
+
+
+def hash_tree( node):
+	"""Builds the hash tree of the data given."""
+	if isinstance( node, dict):
+		children = dict( (key, hash_tree( value)) for key, value in node.iteritems())
+		return (_dict_digest( children), children)
+	elif isinstance( node, list):
+		children = [hash_tree( value) for value in node]
+		return (_list_digest( children), children)
+	return (_leaf_digest( node), None)
+
+
+def _hash_update( tree, path, subtree):
+	"""Returns a new hash tree with the node at the path given replaced.
+
+	Nodes on the path are rehashed, all other nodes are shared with the
+	original tree.
+
+	Args:
+		tree: original hash tree
+		path: path to the node, the path must exist up to its last element
+		subtree: hash tree of the new node or None to remove the node
+	"""
+	if len( path) == 0:
+		return subtree
+
+	children = tree[1]
+	head = path[0]
+	if isinstance( children, dict):
+		children = dict( children)
+		if len( path) == 1 and subtree is None:
+			del children[ head]
+		else:
+			children[ head] = _hash_update( children.get( head), path[1:], subtree)
+		return (_dict_digest( children), children)
+	else:
+		children = list( children)
+		index = int( head)
+		if len( path) == 1 and subtree is None:
+			del children[ index]
+		else:
+			children[ index] = _hash_update( children[ index], path[1:], subtree)
+		return (_list_digest( children), children)
+
+
+def _new_bytes( old_hashes, new_hashes, node):
+	"""Estimates memory taken by nodes of the new tree not shared with the
+	old one.
+
+	Shared subtrees are recognized by identity of their hash tree nodes, so
+	only nodes introduced by the new tree are walked.
+
+	Args:
+		old_hashes: hash tree of the old version or None
+		new_hashes: hash tree of the new version
+		node: data of the new version
+	"""
+	if new_hashes is old_hashes:
+		return 0
+	size = NODE_BYTES
+	children = new_hashes[1]
+	old_children = old_hashes is not None and old_hashes[1] or None
+	if isinstance( children, dict):
+		if not isinstance( old_children, dict):
+			old_children = {}
+		for key, child in children.iteritems():
+			size += len( key) +_new_bytes( old_children.get( key), child, node[ key])
+	elif isinstance( children, list):
+		# Items may be shifted, look them up by identity
+		shared = {}
+		if isinstance( old_children, list):
+			shared = dict( (id( child), child) for child in old_children)
+		for index, child in enumerate( children):
+			size += _new_bytes( shared.get( id( child)), child, node[ index])
+	elif isinstance( node, basestring):
+		size += len( node)
+	return size
+
+
+def _shallow_copy( node):
+	"""Copies the dictionary or list given, leaves are returned as they are."""
+	if isinstance( node, dict):
+		return dict( node)
+	elif isinstance( node, list):
+		return list( node)
+	return node
+
+
 class Data:
 	"""Data store.
 
 	Data store consists of data itselfs and its version.
 	"""
 
-	def __init__( self, new_data={}, sequence=0):
+	def __init__( self, new_data={}, sequence=0, hashes=None):
 		"""Initializes the data store.
 
 		If no instance is passed, then the datastore is created empty.
 
 		Args:
-			new_data: Data to be used in this instance, making a copy of it
+			new_data: Data to be used in this instance, shared, not copied
 			sequence: New sequence to assign or None
+			hashes: Hash tree of new_data if already known
 		"""
-		self.data = copy.deepcopy( new_data)
+		self.data = new_data
+		if hashes is None:
+			hashes = hash_tree( self.data)
+		self.hashes = hashes
 		self.version = DataVersion( sequence, self.get_checksum())
+		self._reset_index()
+
+	def _reset_index( self):
+		"""Drops the path index, it must be called whenever data change."""
+		# Path tuple -> (node, hash tree node), built lazily by lookups
+		self._index = {}
+		# Time spent by building the index in seconds
+		self._index_time = 0.0
 
 	@staticmethod
 	def copy( inst):
-		return Data( inst.data, inst.version.sequence)
+		return Data( inst.data, inst.version.sequence, inst.hashes)
 
 	def load( self, str_data):
 		try:
 			self.data = helpers.load_json( str_data)
 		except ValueError:
 			return False
+		self.hashes = hash_tree( self.data)
+		self._reset_index()
 		return True
 
+	def _copy_path( self, path):
+		"""Copies dictionaries and lists on the path given.
+
+		The path must exist. Nodes outside of the path are shared.
+
+		Returns:
+			New root and the copy of the node at the path
+		"""
+		root = _shallow_copy( self.data)
+		node = root
+		for elem in path:
+			if isinstance( node, list):
+				elem = int( elem)
+			child = _shallow_copy( node[ elem])
+			node[ elem] = child
+			node = child
+		return root, node
+
 	@staticmethod
 	def traverse( what, path):
 		""" Traverses the data tree following the path given.
@@ -145,16 +319,77 @@ class Data:
 
 		Returns None if the path is invalid.
 		"""
-		node = self.traverse( self.data, path)
+		node, _ = self._lookup( path)
 		return node
 
+	def get_digest( self, path):
+		""" Retrieves digest of the data subsection.
+
+		Returns None if the path is invalid.
+		"""
+		_, hashes = self._lookup( path)
+		if hashes is None:
+			return None
+		return hashes[0]
+
+	def _lookup( self, path):
+		""" Finds the data subsection and its hash tree node.
+
+		Paths found are stored in the index, so repeated lookups of the same
+		path are a single dictionary access.
+
+		Returns None, None if the path is invalid.
+		"""
+		key = tuple( path)
+		found = self._index.get( key)
+		if found is not None:
+			return found
+
+		start = time.time()
+		node = self.data
+		hashes = self.hashes
+		for elem in path:
+			try:
+				if isinstance( node, list):
+					index = int(elem)
+					node = node[ index]
+					hashes = hashes[1][ index]
+				elif isinstance( node, dict):
+					node = node[ elem]
+					hashes = hashes[1][ elem]
+				else:
+					return None, None
+			except (ValueError, KeyError, IndexError):
+				return None, None
+		found = (node, hashes)
+		if len( self._index) < INDEX_SIZE:
+			self._index[ key] = found
+		self._index_time += time.time() -start
+		return found
+
+	def index_stats( self):
+		"""Returns statistics of the path index.
+
+		Size is an estimate of memory taken by the index itself in bytes,
+		indexed data are shared with the data store.
+		"""
+		index = dict( self._index)
+		size = sys.getsizeof( index)
+		for key, value in index.iteritems():
+			size += sys.getsizeof( key) +sys.getsizeof( value)
+		return {
+			'entries': len( index),
+			'build-time': self._index_time,
+			'bytes': size,
+		}
+
 	def get_checksum( self):
 		"""
-		Calculates a checksum of the data in a predictable way.
+		Returns a checksum of the data calculated in a predictable way.
+
+		It is the digest of the hash tree root.
 		"""
-		m = md5.new()
-		m.update( helpers.dump_json( self.data))
-		return m.hexdigest()
+		return self.hashes[0]
 
 	def set( self, path, content):
 		""" Stores the content given and the position specified.
@@ -165,25 +400,32 @@ class Data:
 		"""
 		if len( path) == 0:
 			self.data = content
+			self.hashes = hash_tree( content)
+			self._reset_index()
 			return True
 
 		last = path[-1]
 		node = self.traverse( self.data, path[:-1])
-		if not node:
+		if node is None:
 			return False
 		# Check where we are
 		if isinstance( node, list):
 			# Store at index
 			# FIXME - index points after end?
+			root, node = self._copy_path( path[:-1])
 			node[ int(last)] = content
-			return False #FIXME: here we should return True, shouldn't we?
+			self.data = root
 		elif isinstance( node, dict):
 			# If it is a dict, retrieve by a name
+			root, node = self._copy_path( path[:-1])
 			node[ last] = content
+			self.data = root
 		else:
 			# This is a leaf and cannot be addressed
 			return False
 
+		self.hashes = _hash_update( self.hashes, path, hash_tree( content))
+		self._reset_index()
 		return True
 
 	def delete( self, path):
@@ -195,6 +437,8 @@ class Data:
 		"""
 		if len( path) == 0:
 			self.data = {}
+			self.hashes = hash_tree( self.data)
+			self._reset_index()
 			return True
 		
 		last = path[-1]
@@ -202,26 +446,138 @@ class Data:
 		if not node:
 			return None
 
-		# Perform the detele operation
+		# This is a leaf and cannot be sub-indexed
+		if not isinstance( node, (list, dict)):
+			return False
+
+		# Perform the detele operation on a copy of the path
+		root, node = self._copy_path( path[:-1])
 		try:
 			if isinstance( node, list):
 				# Delete item by index
 				del node[ int(last)]
-			elif isinstance( node, dict):
+			else:
 				# If it is a dict, retrieve by a name
 				del node[ last]
-			else:
-				# This is a leaf and cannot be sub-indexed
-				return False
 		except (ValueError, KeyError, IndexError):
 			return False
 
+		self.data = root
+		self.hashes = _hash_update( self.hashes, path, None)
+		self._reset_index()
+		return True
+
+	def patch( self, ops):
+		"""Applies the changes given in the form returned by diff().
+
+		Returns True if all changes have been applied.
+		"""
+		for op in ops:
+			try:
+				if op[ 'op'] in ('add', 'replace'):
+					done = self.set( op[ 'path'], op[ 'value'])
+				elif op[ 'op'] == 'remove':
+					done = self.delete( op[ 'path'])
+				else:
+					done = False
+			except (TypeError, KeyError, ValueError, IndexError):
+				return False
+			if not done:
+				return False
 		return True
 
 
+def _diff( old, new, old_hashes, new_hashes, path, ops):
+	# Skip identical subtrees
+	if old_hashes[0] == new_hashes[0]:
+		return
+
+	if isinstance( old, dict) and isinstance( new, dict):
+		for key in old:
+			if key not in new:
+				ops.append( {'op': 'remove', 'path': path +[key]})
+		for key, value in new.iteritems():
+			if key in old:
+				_diff( old[ key], value, old_hashes[1][ key], new_hashes[1][ key], path +[key], ops)
+			else:
+				ops.append( {'op': 'add', 'path': path +[key], 'value': value})
+	elif isinstance( old, list) and isinstance( new, list) and len( old) == len( new):
+		for index in xrange( len( new)):
+			_diff( old[ index], new[ index], old_hashes[1][ index], new_hashes[1][ index], path +[index], ops)
+	else:
+		ops.append( {'op': 'replace', 'path': path, 'value': new})
+
+
+def diff( old, new):
+	"""Calculates differences between two data stores.
+
+	Only subtrees with different digests are visited.
+
+	Returns:
+		List of JSON-Patch-like operations transforming old to new. Each
+		operation is a dictionary with 'op' (add, replace or remove), 'path'
+		(list of elements) and 'value' (except for remove).
+	"""
+	ops = []
+	_diff( old.data, new.data, old.hashes, new.hashes, [], ops)
+	return ops
+
+
+def project( entry, depth=None, keys_only=False, fields=None):
+	"""Returns the part of the entry given that was requested.
+
+	Only the parts returned are visited, so the cost depends on the size of
+	the projection, not the entry.
+
+	Args:
+		entry: data entry
+		depth: number of levels of nested dictionaries and lists returned,
+			deeper ones are returned empty
+		keys_only: return only keys of a dictionary or indexes of a list
+		fields: keys of a dictionary to return, others are omitted
+	"""
+	if fields is not None and isinstance( entry, dict):
+		entry = dict( [(key, entry[ key]) for key in fields if key in entry])
+	if keys_only:
+		if isinstance( entry, dict):
+			return sorted( entry.keys())
+		if isinstance( entry, list):
+			return range( len( entry))
+		return []
+	if depth is not None:
+		return _truncate( entry, depth)
+	return entry
+
+
+def _truncate( entry, depth):
+	if isinstance( entry, dict):
+		if depth <= 0:
+			return {}
+		return dict( [(key, _truncate( value, depth -1)) for key, value in entry.iteritems()])
+	if isinstance( entry, list):
+		if depth <= 0:
+			return []
+		return [_truncate( value, depth -1) for value in entry]
+	return entry
+
+
 # Data structure
 _data = Data()
 
+# Recently committed data as [data, estimated size, previous data], the newest
+# is the last one. Versions share unchanged subtrees, so the size of a version
+# is the size of nodes it introduced. The size is None and the previous data
+# are kept until the size is estimated without the lock, see _account_history.
+_history = collections.deque( [[_data, 0, None]])
+# Estimated size of all versions in _history
+_history_bytes = 0
+# Limits of _history
+_history_size = HISTORY_SIZE
+_history_max_bytes = HISTORY_BYTES
+
+# Signalled when current data change
+_changed = threading.Condition( threading.Lock())
+
 # This points to _data when we are in Service Unavailable State
 _unavailable_data = None
 
@@ -242,6 +598,10 @@ def set_bootstrap_limit( bootstrap_limit):
 def _check_avail():
 	global _data, _unavailable_data, _lock, _bootstrap_limit
 
+	# Avoid locking when the service is available
+	if _unavailable_data is None:
+		return
+
 	with _lock:
 		if _data is _unavailable_data:
 			if _bootstrap_limit <= helpers.now():
@@ -255,11 +615,33 @@ def _check_avail():
 #
 
 def get_data( path):
-	global _data, _lock
-	with _lock:
-		_check_avail()
+	_check_avail()
+
+	return cur_data().get( path)
+
+def get_data_digest( path):
+	"""Returns data subsection together with its digest and data version.
+
+	All are taken from the same version of data.
+	"""
+	_check_avail()
+
+	snapshot = cur_data()
+	return snapshot.get( path), snapshot.get_digest( path), snapshot.version
+
+def get_batch( paths):
+	"""Returns data subsections of all paths given together with data
+	version.
 
-		return _data.get( path)
+	All subsections are taken from the same version of data.
+
+	Returns:
+		List of subsections, None for invalid paths, and data version
+	"""
+	_check_avail()
+
+	snapshot = cur_data()
+	return [snapshot.get( path) for path in paths], snapshot.version
 
 def get_update( path):
 	global _update, _lock
@@ -345,7 +727,20 @@ def try_acquire_lock( code):
 
 
 
-def release_lock():
+def _accounted( func):
+	"""Decorates functions committing data, sizes of new versions are
+	estimated once they return."""
+	def accounted( *args, **kwargs):
+		try:
+			return func( *args, **kwargs)
+		finally:
+			_account_history()
+	accounted.__name__ = func.__name__
+	accounted.__doc__ = func.__doc__
+	return accounted
+
+
+def _release_lock():
 	"""Releases the client's lock.
 
 	New data are commited.
@@ -376,12 +771,46 @@ def release_lock():
 
 		# Do the update of internal structure
 		if _data.version.checksum != new_data.version.checksum:
-			_data = new_data
+			_set_data( new_data)
 		_update = Data()
 		_lock_timestamp = 0
 
 		return LCK_OK
 
+release_lock = _accounted( _release_lock)
+
+
+@_accounted
+def transaction( ops, base=None):
+	"""Applies all operations given atomically.
+
+	The update is done the same way as by a client holding the lock, but
+	the lock is held only for the time of this call.
+
+	Args:
+		ops: list of operations in the form accepted by Data.patch
+		base: version the operations are based on, None for any
+	Returns:
+		TRX_* code and version of current data
+	"""
+	global _data, _update, _lock
+
+	with _lock:
+		_check_avail()
+
+		if get_lock_code() is not None:
+			return TRX_LOCKED, _data.version
+		if base is not None and base != _data.version:
+			return TRX_CONFLICT, _data.version
+
+		try_acquire_lock( TRX_LOCK_CODE)
+		if not _update.patch( ops):
+			abort_update()
+			return TRX_FAILED, _data.version
+		if _release_lock() != LCK_OK:
+			return TRX_CONFLICT, _data.version
+		return TRX_OK, _data.version
+
 
 def abort_update():
 	"""Terminates the current update.
@@ -398,13 +827,102 @@ def abort_update():
 		return True
 
 
+def _set_data( new_data):
+	"""Makes the data given current. Must be called with the lock held.
+
+	Size of the new version is estimated later by _account_history.
+	"""
+	global _data, _history, _changed
+
+	_history.append( [new_data, None, _data])
+	_data = new_data
+	_trim_history()
+	metrics.inc( 'lighthouse_commits_total')
+
+	# Wake up clients waiting for changes
+	with _changed:
+		_changed.notify_all()
+
+
+def _trim_history():
+	"""Drops the oldest versions over limits, current data are always kept."""
+	global _history, _history_bytes
+
+	while len( _history) > 1 and (len( _history) > _history_size
+			or _history_bytes > _history_max_bytes):
+		entry = _history.popleft()
+		_history_bytes -= entry[1] or 0
+		# Not estimated yet, it is not accounted at all
+		entry[1] = 0
+		entry[2] = None
+
+
+def _account_history():
+	"""Estimates sizes of new versions and drops the oldest versions over
+	limits. Must be called without the lock, nodes introduced by new
+	versions are walked.
+	"""
+	global _history, _history_bytes, _lock
+
+	with _lock:
+		pending = [entry for entry in _history if entry[1] is None]
+	if not pending:
+		return
+	for entry in pending:
+		new, _, previous = entry
+		if previous is None:
+			continue
+		size = _new_bytes( previous.hashes, new.hashes, new.data)
+		with _lock:
+			if entry[1] is None:
+				entry[1] = size
+				entry[2] = None
+				_history_bytes += size
+	with _lock:
+		_trim_history()
+
+
+def set_history_limits( size=HISTORY_SIZE, size_bytes=HISTORY_BYTES):
+	"""Sets limits of recent versions kept in memory.
+
+	Args:
+		size: maximal number of versions
+		size_bytes: maximal estimated size of versions in bytes
+	"""
+	global _history_size, _history_max_bytes, _lock
+
+	with _lock:
+		_history_size = max( 1, size)
+		_history_max_bytes = size_bytes
+		_trim_history()
+
+
+def get_history():
+	"""Returns versions kept in memory, the oldest first."""
+	return [entry[0].version for entry in list( _history)]
+
+
+@_accounted
 def push_data( copy):
+	"""Accepts a copy of data from another instance if it is newer.
+
+	The copy contains either complete data or a patch (see get_delta). The
+	patch is applied only if its base is the current version and the result
+	matches the checksum of the copy.
+
+	Returns:
+		True if the copy has been accepted
+	"""
 	global _logger, _data, _lock
 
 	try:
 		copy_ver = DataVersion.from_dict( copy[ 'version'])
-		copy_data = copy[ 'data']
-	except KeyError:
+		if 'patch' in copy:
+			copy_base = DataVersion.from_dict( copy[ 'base'])
+			copy_patch = copy[ 'patch']
+		else:
+			copy_data = copy[ 'data']
+	except (TypeError, KeyError):
 		_logger.error( 'Invalid or missing version in copy')
 		return False
 
@@ -413,27 +931,171 @@ def push_data( copy):
 		if copy_ver <= _data.version:
 			return False
 		# Configuration is newer, upload it
-		_data = Data( copy_data, copy_ver.sequence)
+		if 'patch' not in copy:
+			_set_data( Data( copy_data, copy_ver.sequence))
+			return True
+
+		# Patch must be based on our version
+		if copy_base != _data.version:
+			return False
+		new_data = Data.copy( _data)
+		if not new_data.patch( copy_patch):
+			_logger.warning( 'Cannot apply patch to %s', _data.version.to_dict())
+			return False
+		new_data = Data( new_data.data, copy_ver.sequence, new_data.hashes)
+		if new_data.version != copy_ver:
+			_logger.warning( 'Checksum mismatch after patch: %s', new_data.version.to_dict())
+			return False
+		_set_data( new_data)
 		return True
 
 
+def is_newer( copy):
+	"""Checks that version of the copy given is newer than current data."""
+	try:
+		return DataVersion.from_dict( copy[ 'version']) > cur_data().version
+	except (TypeError, KeyError, ValueError):
+		return False
+
+
+def find_version( version):
+	"""Returns recent data of the version given or None if not known."""
+	for entry in reversed( list( _history)):
+		recent = entry[0]
+		if recent.version == version:
+			return recent
+	return None
+
+
+def find_sequence( sequence):
+	"""Returns recent data of the sequence given or None if not known."""
+	for entry in reversed( list( _history)):
+		recent = entry[0]
+		if recent.version.sequence == sequence:
+			return recent
+	return None
+
+
+def get_data_at( path, sequence):
+	"""Returns data subsection of the version with sequence given together
+	with its digest and data version.
+
+	Returns None, None, None if the path is invalid or the version is not
+	known.
+	"""
+	_check_avail()
+
+	recent = find_sequence( sequence)
+	if recent is None:
+		return None, None, None
+	return recent.get( path), recent.get_digest( path), recent.version
+
+
+def changed_since( path, sequence):
+	"""Checks that data subsection has changed since the version with
+	sequence given.
+
+	Subsection of a version which is not kept anymore is considered changed.
+	"""
+	current = cur_data()
+	if current.version.sequence <= sequence:
+		return False
+	old = find_sequence( sequence)
+	if old is None:
+		return True
+	return old.get_digest( path) != current.get_digest( path)
+
+
+def wait_data( path, sequence, timeout):
+	"""Waits until data subsection changes since the version with sequence
+	given.
+
+	Waiting threads are woken up when new data are committed or pushed.
+
+	Args:
+		path: path to the subsection
+		sequence: sequence of the version the client has
+		timeout: maximal time to wait in seconds
+	Returns:
+		True if the subsection has changed, False on timeout
+	"""
+	global _changed
+
+	_check_avail()
+
+	deadline = time.time() +timeout
+	with _changed:
+		while not changed_since( path, sequence):
+			remaining = deadline -time.time()
+			if remaining <= 0:
+				return False
+			_changed.wait( remaining)
+	return True
+
+
+def get_diff( from_sequence, to_sequence=None):
+	"""Returns changes between two recent versions.
+
+	Args:
+		from_sequence: sequence of the original version
+		to_sequence: sequence of the new version or None for current data
+	Returns:
+		Dictionary with 'from' and 'to' versions and 'patch' (see diff())
+		or None if the versions are not known.
+	"""
+	_check_avail()
+
+	old = find_sequence( from_sequence)
+	if to_sequence is None:
+		new = cur_data()
+	else:
+		new = find_sequence( to_sequence)
+	if old is None or new is None:
+		return None
+
+	response = {}
+	response[ 'from'] = old.version.to_dict()
+	response[ 'to'] = new.version.to_dict()
+	response[ 'patch'] = diff( old, new)
+	return response
+
+
+def get_delta( base):
+	"""Returns changes of current data since the base version given.
+
+	The result has the same form as get_copy() but contains 'base' version
+	and 'patch' with the list of changes instead of 'data'. Returns None if
+	the base version is not known.
+	"""
+	snapshot = cur_data()
+	old = find_version( base)
+	if old is None:
+		return None
+
+	response = {}
+	response[ 'version'] = snapshot.version.to_dict()
+	response[ 'base'] = old.version.to_dict()
+	response[ 'patch'] = diff( old, snapshot)
+	return response
+
+
 def get_copy( get_data=True):
 	"""Returns raw copy of current data, including version information.
 
 	Args:
 		get_data: include complete copy of data store
 	"""
-	global _data, _lock
-
-	with _lock:
-		response = {}
-		# Collect data version
-		response[ 'version'] = _data.version.to_dict()
-		# Collect data if required
-		if get_data:
-			response[ 'data'] = _data.data
-		# Return response
-		return response
+	# Take a snapshot, the version and data must match
+	snapshot = cur_data()
+
+	response = {}
+	# Collect data version
+	response[ 'version'] = snapshot.version.to_dict()
+	# Collect data if required
+	if get_data:
+		response[ 'data'] = snapshot.data
+	# Return response
+	return response
 
 
 def cur_data():
@@ -0,0 +1,510 @@
+#! /usr/bin/python
+# Copyright (c) 2012, 2013 Viliam Holub, Logentries
+
+"""Event loop HTTP server implementation.
+
+An alternative to the threaded server. All connections are served by a single
+thread multiplexing sockets via poll, so idle persistent connections and
+clients waiting for changes do not hold a thread each.
+
+Requests are processed by the same handler as in the threaded server. Request
+is read completely by the loop first and then handled from memory. Clients
+waiting for changes are parked and handled again when data change or their
+timeout expires.
+
+Sockets stay registered with poll, only connections with events or changed
+are checked again, so that the loop does not walk all connections. Parked
+requests are handled again when data change or by a heap of their deadlines,
+idle connections are closed in order of their last activity.
+
+Requests are handled one at a time, only parked requests are held by the loop
+concurrently. So admission control limits parked requests only, a parked
+request stays admitted until it is answered.
+
+"""
+
+# System imports
+import asyncore
+import asynchat
+import collections
+import errno
+import heapq
+import itertools
+import logging
+import select
+import socket
+import time
+import cStringIO
+
+# Local imports
+from __init__ import SERVER_NAME
+from __init__ import __version__
+import data
+import server
+
+# Maximal time the loop waits for socket events in seconds. It limits delay
+# of parked clients too.
+LOOP_TIMEOUT = 0.05
+# Maximal size of request headers
+MAX_HEADERS = 65536
+# Maximal number of parked requests
+MAX_PARKED = 10000
+
+_logger = logging.getLogger(__name__)
+
+# Responses sent to requests which cannot be handled
+RESPONSE_ERROR = 'HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+RESPONSE_BAD_REQUEST = RESPONSE_ERROR%'400 Bad Request'
+RESPONSE_LENGTH_REQUIRED = RESPONSE_ERROR%'411 Length Required'
+RESPONSE_TOO_LARGE = RESPONSE_ERROR%'413 Request Entity Too Large'
+RESPONSE_TIMEOUT = RESPONSE_ERROR%'408 Request Timeout'
+
+
+class Parked( Exception):
+	"""Raised by a handler to postpone the request until data change."""
+
+	def __init__(self, deadline, route):
+		Exception.__init__( self)
+		self.deadline = deadline
+		# Route class the parked request is admitted in
+		self.route = route
+
+
+class BufferedRequestHandler( server.LighthouseRequestHandler):
+	"""Handles one request read in memory, the response is kept in memory
+	as well.
+	"""
+
+	def __init__(self, request, client_address, loop_server, deadline=None):
+		# Deadline of a parked request
+		self.deadline = deadline
+		server.LighthouseRequestHandler.__init__( self, request, client_address, loop_server)
+
+	def setup(self):
+		self.rfile = cStringIO.StringIO( self.request)
+		self.wfile = cStringIO.StringIO()
+
+	def handle(self):
+		self.handle_one_request()
+
+	def finish(self):
+		pass
+
+	def _admit(self, route):
+		# A parked request handled again has been admitted already
+		if self.deadline is not None:
+			return True
+		return server.LighthouseRequestHandler._admit( self, route)
+
+	def _wait_data(self, blocks, sequence, timeout):
+		"""Parks the request instead of waiting."""
+		if data.changed_since( blocks, sequence):
+			return True
+		if self.deadline is not None and self.deadline <= time.time():
+			return False
+		deadline = self.deadline
+		if deadline is None:
+			deadline = time.time() +timeout
+		# The parked request keeps its admission, see Connection.close
+		route, self._route = self._route, None
+		raise Parked( deadline, route)
+
+
+class Connection( asynchat.async_chat):
+	"""One client connection.
+
+	Complete requests are queued and handled one by one in order.
+	"""
+
+	def __init__(self, sock, client_address, loop_server):
+		asynchat.async_chat.__init__( self, sock)
+		self.client_address = client_address
+		self.loop_server = loop_server
+		# Data of the request being read
+		self._incoming = []
+		self._headers = None
+		# Time when reading of the current request started
+		self.started = None
+		# Complete requests waiting to be handled
+		self._requests = collections.deque()
+		# Deadline of the parked request or None
+		self.parked = None
+		# Route class the parked request is admitted in
+		self._parked_route = None
+		# Time of last activity
+		self.last_active = None
+		self.set_terminator( '\r\n\r\n')
+		loop_server.watch( self)
+		self._touch()
+
+	def _touch(self):
+		"""Notes activity of the connection."""
+		self.last_active = time.time()
+		self.loop_server.touch( self)
+
+	def collect_incoming_data(self, data):
+		self._incoming.append( data)
+		self._touch()
+		if self.started is None:
+			self.started = self.last_active
+			self.loop_server.reading( self)
+		if self._headers is None and sum( [len( x) for x in self._incoming]) > MAX_HEADERS:
+			self._refuse( RESPONSE_BAD_REQUEST)
+
+	def found_terminator(self):
+		if self._headers is None:
+			# Headers are complete, read the body if there is any
+			self._headers = ''.join( self._incoming) +'\r\n\r\n'
+			self._incoming = []
+			if self._header( self._headers, 'transfer-encoding') is not None:
+				return self._refuse( RESPONSE_LENGTH_REQUIRED)
+			size = self._content_length( self._headers)
+			if size is None:
+				return self._refuse( RESPONSE_BAD_REQUEST)
+			if size > server.LighthouseRequestHandler.max_body:
+				return self._refuse( RESPONSE_TOO_LARGE)
+			if size > 0:
+				self.set_terminator( size)
+				return
+		# Request is complete
+		self._requests.append( self._headers +''.join( self._incoming))
+		self._headers = None
+		self._incoming = []
+		self.started = None
+		self.loop_server.reading( self, False)
+		self.set_terminator( '\r\n\r\n')
+		# A request following a parked one waits for it
+		if self.parked is None:
+			self.process()
+
+	def _header(self, headers, header):
+		"""Returns value of the header given or None."""
+		for line in headers.split( '\r\n')[1:]:
+			name, _, value = line.partition( ':')
+			if name.strip().lower() == header:
+				return value.strip()
+		return None
+
+	def _content_length(self, headers):
+		"""Returns size of the request body or None if invalid."""
+		value = self._header( headers, 'content-length')
+		if value is None:
+			return 0
+		try:
+			size = int( value)
+		except ValueError:
+			return None
+		if size < 0:
+			return None
+		return size
+
+	def _refuse(self, response):
+		"""Sends the error response given and closes the connection."""
+		self._requests.clear()
+		self._incoming = []
+		self.started = None
+		self.loop_server.reading( self, False)
+		self.loop_server.changed( self)
+		self.set_terminator( None)
+		self.push( response)
+		self.close_when_done()
+
+	def process(self):
+		"""Handles queued requests until a request is parked."""
+		self.loop_server.changed( self)
+		while self._requests and self.connected:
+			request = self._requests[0]
+			try:
+				handler = BufferedRequestHandler( request, self.client_address,
+						self.loop_server, self.parked)
+			except Parked, e:
+				if self.parked is None:
+					self.parked = e.deadline
+					self._parked_route = e.route
+					self.loop_server.park( self)
+				return
+			except:
+				# Admission of a parked request is left by the handler
+				self._unpark()
+				# Close this connection only, not the loop
+				self.handle_error()
+				return
+			self._requests.popleft()
+			self._unpark()
+			self.push( handler.wfile.getvalue())
+			if handler.close_connection:
+				self._requests.clear()
+				self.close_when_done()
+				return
+		self._touch()
+
+	def _unpark(self):
+		"""Notes the parked request, if any, is not parked any more."""
+		if self.parked is not None:
+			self.parked = self._parked_route = None
+			self.loop_server.unpark( self)
+
+	def readable(self):
+		# Requests following a waiting one are not read, except one after
+		# a parked request, so that the client closing is noticed
+		if self._requests and (self.parked is None or len( self._requests) > 1):
+			return False
+		return asynchat.async_chat.readable( self)
+
+	def handle_close(self):
+		self.close()
+
+	def close(self):
+		if self._parked_route is not None:
+			server.admission.leave( self._parked_route)
+			self._parked_route = None
+		self._unpark()
+		self.loop_server.unwatch( self)
+		asynchat.async_chat.close( self)
+
+	def handle_error(self):
+		_logger.exception( 'Error handling request of %s', self.client_address)
+		self.close()
+
+
+class EventLoopServer( asyncore.dispatcher):
+	"""Accepts connections and runs the loop."""
+
+	def __init__(self, bind_address, keepalive_timeout=server.KEEPALIVE_TIMEOUT):
+		"""Listens on the TCP address given, no address for other listeners
+		only."""
+		asyncore.dispatcher.__init__( self)
+		self.keepalive_timeout = keepalive_timeout
+		self._poll = select.poll()
+		# File descriptor -> events registered
+		self._events = {}
+		# Sockets whose events are to be registered again
+		self._changed = set()
+		# Connections with parked requests
+		self._parked = set()
+		# (deadline, order, connection) of parked requests, entries of
+		# requests answered meanwhile are stale
+		self._deadlines = []
+		self._order = itertools.count()
+		# Data version seen by parked requests
+		self._parked_data = None
+		# Connections not parked in order of their last activity
+		self._active = collections.OrderedDict()
+		# Connections reading a request in order they started
+		self._reading = collections.OrderedDict()
+		if bind_address is not None:
+			self.create_socket( socket.AF_INET, socket.SOCK_STREAM)
+			self.set_reuse_addr()
+			self.bind( bind_address)
+			self.listen( server.QUEUE_SIZE)
+			self.watch( self)
+
+	def handle_accept(self):
+		try:
+			pair = self.accept()
+		except socket.error:
+			return
+		if pair is None:
+			return
+		sock, client_address = pair
+		sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		Connection( sock, client_address, self)
+
+	def listen_unix(self, path, mode):
+		"""Accepts connections of a Unix domain socket as well."""
+		UnixListener( path, mode, self)
+
+	def close(self):
+		self.unwatch( self)
+		asyncore.dispatcher.close( self)
+
+	def watch(self, dispatcher):
+		"""Registers events of the socket given with the next poll."""
+		self._changed.add( dispatcher)
+
+	def changed(self, dispatcher):
+		"""Notes events of the socket given may have changed."""
+		self._changed.add( dispatcher)
+
+	def unwatch(self, dispatcher):
+		"""Stops watching the socket given, it is being closed."""
+		self._changed.discard( dispatcher)
+		self._active.pop( dispatcher, None)
+		self._reading.pop( dispatcher, None)
+		fd = dispatcher._fileno
+		if fd is not None and self._events.pop( fd, None) is not None:
+			self._poll.unregister( fd)
+
+	def touch(self, connection):
+		"""Moves the connection given to the end of the idle order."""
+		self._active.pop( connection, None)
+		if connection.parked is None:
+			self._active[ connection] = None
+
+	def reading(self, connection, started=True):
+		"""Notes the connection given started or finished reading a request."""
+		if not started:
+			self._reading.pop( connection, None)
+		elif connection not in self._reading:
+			self._reading[ connection] = None
+
+	def park(self, connection):
+		"""Notes a request of the connection given is parked."""
+		self._parked.add( connection)
+		self._active.pop( connection, None)
+		heapq.heappush( self._deadlines, (connection.parked, self._order.next(), connection))
+
+	def unpark(self, connection):
+		"""Notes the parked request of the connection given is answered."""
+		self._parked.discard( connection)
+		self.touch( connection)
+
+	def _wake_parked(self):
+		"""Handles parked requests again if data changed or they expired."""
+		now = time.time()
+		current = data.cur_data()
+		if current is not self._parked_data:
+			self._parked_data = current
+			for connection in list( self._parked):
+				connection.process()
+		while self._deadlines and self._deadlines[0][0] <= now:
+			_, _, connection = heapq.heappop( self._deadlines)
+			# Skip requests answered or parked again
+			if connection.parked is not None and connection.parked <= now:
+				connection.process()
+
+	def queue_depth(self):
+		"""Returns number of connections with requests waiting."""
+		# Requests are queued behind parked ones only
+		return len( self._parked)
+
+	def _close_idle(self):
+		"""Closes idle persistent connections and refuses slow requests."""
+		now = time.time()
+		limit = now -self.keepalive_timeout
+		while self._active:
+			connection = next( iter( self._active))
+			if connection.last_active >= limit:
+				break
+			if connection.producer_fifo or connection._requests or connection.started is not None:
+				# Sending a response or reading a request, not idle
+				connection._touch()
+			else:
+				connection.close()
+		limit = now -server.BODY_TIMEOUT
+		while self._reading:
+			connection = next( iter( self._reading))
+			if connection.started >= limit:
+				break
+			connection._refuse( RESPONSE_TIMEOUT)
+
+	def _register(self):
+		"""Registers events of changed sockets with poll."""
+		for dispatcher in self._changed:
+			fd = dispatcher._fileno
+			if fd is None or asyncore.socket_map.get( fd) is not dispatcher:
+				continue
+			events = 0
+			if dispatcher.readable():
+				events |= select.POLLIN | select.POLLPRI
+			if dispatcher.writable() and not dispatcher.accepting:
+				events |= select.POLLOUT
+			if events:
+				events |= select.POLLERR | select.POLLHUP | select.POLLNVAL
+			registered = self._events.get( fd)
+			if events == registered:
+				continue
+			if not events:
+				del self._events[ fd]
+				self._poll.unregister( fd)
+			elif registered is None:
+				self._events[ fd] = events
+				self._poll.register( fd, events)
+			else:
+				self._events[ fd] = events
+				self._poll.modify( fd, events)
+		self._changed.clear()
+
+	def poll_once(self, timeout):
+		"""Waits for socket events up to the timeout given in seconds and
+		handles them."""
+		self._register()
+		try:
+			events = self._poll.poll( timeout *1000)
+		except select.error, e:
+			if e.args[0] != errno.EINTR:
+				raise
+			return
+		for fd, flags in events:
+			dispatcher = asyncore.socket_map.get( fd)
+			if dispatcher is None:
+				continue
+			asyncore.readwrite( dispatcher, flags)
+			self._changed.add( dispatcher)
+
+	def serve_forever(self):
+		last_check = time.time()
+		while True:
+			self.poll_once( LOOP_TIMEOUT)
+			self._wake_parked()
+			if time.time() -last_check > 1:
+				last_check = time.time()
+				self._close_idle()
+
+
+class UnixListener( asyncore.dispatcher):
+	"""Accepts connections of a Unix domain socket to the loop given."""
+
+	def __init__(self, path, mode, loop_server):
+		asyncore.dispatcher.__init__( self)
+		self.loop_server = loop_server
+		self.create_socket( socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind_unix( self.socket, path, mode)
+		self.listen( server.QUEUE_SIZE)
+		loop_server.watch( self)
+
+	def close(self):
+		self.loop_server.unwatch( self)
+		asyncore.dispatcher.close( self)
+
+	def handle_accept(self):
+		try:
+			pair = self.accept()
+		except socket.error:
+			return
+		if pair is None:
+			return
+		sock, client_address = pair
+		Connection( sock, client_address, self.loop_server)
+
+
+def run( bind_address, keepalive_timeout=server.KEEPALIVE_TIMEOUT, max_body=server.MAX_BODY,
+		limits={}, unix_socket=None, unix_socket_mode=server.UNIX_SOCKET_MODE):
+	"""Runs the event loop server.
+
+	Args:
+		bind_address: (host, port) tuple to listen on or None
+		keepalive_timeout: time after an idle connection is closed in seconds
+		max_body: maximal size of request content in bytes
+		limits: maximal numbers of parked requests by route class
+		unix_socket: path of a Unix domain socket to listen on or None
+		unix_socket_mode: permissions of the Unix domain socket
+	"""
+	server.LighthouseRequestHandler.server_version = SERVER_NAME +'/' +__version__
+	server.LighthouseRequestHandler.max_body = max_body
+	server.admission.limits[ server.ROUTE_WAIT] = MAX_PARKED
+	server.admission.limits.update( limits)
+	try:
+		httpd = EventLoopServer( bind_address, keepalive_timeout)
+		if bind_address is not None:
+			_logger.info( 'Starting event loop server on %s:%s', bind_address[0], bind_address[1])
+		if unix_socket is not None:
+			httpd.listen_unix( unix_socket, unix_socket_mode)
+			_logger.info( 'Starting event loop server on %s', unix_socket)
+	except (socket.error, OSError), e:
+		_logger.critical( 'Cannot start server: %s', e)
+		return
+	try:
+		httpd.serve_forever()
+	except KeyboardInterrupt:
+		print 'User break'
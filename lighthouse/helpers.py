@@ -2,15 +2,44 @@
 
 # System imports
 import _json as json
-import urllib2
+import httplib
 import logging
 import re
 import datetime
 import sys
 import socket
-import traceback
+import zlib
+import time
+
+# Local imports
+import inlock
+
+# Binary encoding is optional
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
 
 DEFAULT_PORT = 8001
+# Timeout of requests to other instances in seconds
+TIMEOUT = 10
+# Timeout of connecting to other instances in seconds, unreachable ones
+# should not hold the caller long
+CONNECT_TIMEOUT = 1
+# Maximal number of idle connections kept per instance
+POOL_SIZE = 2
+# Idle connections are closed after this time in seconds, sooner than the
+# other side closes them
+POOL_IDLE_TIMEOUT = 10
+
+# Content encodings we can compress and decompress
+ENCODINGS = ['gzip', 'deflate']
+# Minimal size of content worth compressing
+COMPRESS_MIN = 1024
+
+# Content types of data transferred
+TYPE_JSON = 'application/json'
+TYPE_MSGPACK = 'application/x-msgpack'
 
 _logger = logging.getLogger(__name__)
 
@@ -25,6 +54,149 @@ def _url( address, path='/'):
 
 
 
+class ConnectionPool:
+	"""Keeps persistent HTTP connections to other instances for reuse.
+
+	Idle connections are kept per instance up to the size given and closed
+	once idle for too long. A request failing on a reused connection, which
+	the other side may have closed meanwhile, is repeated on a new one.
+	"""
+
+	def __init__(self, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+		inlock.add_lock( self)
+		self.size = size
+		self.idle_timeout = idle_timeout
+		# address -> [(connection, time it became idle)], the last one is the newest
+		self._idle = {}
+		self._stats = {'created': 0, 'reused': 0, 'evicted': 0, 'failed': 0}
+
+	def request(self, address, method, path, body=None, headers={}):
+		"""Sends the request given and reads the response.
+
+		Returns:
+			Status, headers and content of the response
+		Raises:
+			httplib.HTTPException or socket.error if not successful
+		"""
+		connection = self._take( address)
+		if connection is not None:
+			try:
+				return self._send( address, connection, method, path, body, headers)
+			except socket.timeout:
+				self._count( 'failed')
+				raise
+			except (httplib.HTTPException, socket.error):
+				# The other side closed the idle connection meanwhile
+				pass
+		self._count( 'created')
+		try:
+			connection = self._connect( address)
+			return self._send( address, connection, method, path, body, headers)
+		except (httplib.HTTPException, socket.error):
+			self._count( 'failed')
+			raise
+
+	def _connect(self, address):
+		"""Opens a new connection to the instance given, connecting is
+		limited by a shorter timeout than requests."""
+		connection = httplib.HTTPConnection( address, timeout=CONNECT_TIMEOUT)
+		connection.connect()
+		connection.sock.settimeout( TIMEOUT)
+		return connection
+
+	def _send(self, address, connection, method, path, body, headers):
+		try:
+			connection.request( method, path, body, headers)
+			response = connection.getresponse()
+			content = response.read()
+		except:
+			connection.close()
+			raise
+		if response.will_close:
+			connection.close()
+		else:
+			self._give( address, connection)
+		return response.status, response.msg, content
+
+	@inlock.synchronized
+	def _take(self, address):
+		"""Returns an idle connection to the instance given or None."""
+		self._evict()
+		idle = self._idle.get( address)
+		if not idle:
+			return None
+		self._stats[ 'reused'] += 1
+		return idle.pop()[0]
+
+	@inlock.synchronized
+	def _give(self, address, connection):
+		"""Keeps the connection given for reuse."""
+		idle = self._idle.setdefault( address, [])
+		if len( idle) >= self.size:
+			self._stats[ 'evicted'] += 1
+			connection.close()
+		else:
+			idle.append( (connection, time.time()))
+		self._evict()
+
+	def _evict(self):
+		"""Closes connections idle for too long. Must be called with the
+		lock held."""
+		limit = time.time() -self.idle_timeout
+		for address, idle in self._idle.items():
+			while idle and idle[0][1] < limit:
+				idle.pop( 0)[0].close()
+				self._stats[ 'evicted'] += 1
+			if not idle:
+				del self._idle[ address]
+
+	@inlock.synchronized
+	def _count(self, name):
+		self._stats[ name] += 1
+
+	@inlock.synchronized
+	def get_state(self):
+		"""Returns numbers of connections created, reused, evicted and
+		failed and numbers of idle connections by instance."""
+		self._evict()
+		state = dict( self._stats)
+		state[ 'idle'] = dict( [(address, len( idle)) for address, idle in self._idle.iteritems()])
+		return state
+
+# Connections to other instances
+pool = ConnectionPool()
+
+
+def _request( address, method, path, content=None):
+	"""Sends a request to the instance given through the connection pool.
+
+	Content is compressed if worth it and so is the response if the other
+	side supports it.
+
+	Returns:
+		Status, content and content type of the response, all None if the
+		instance is not available
+	"""
+	headers = {
+		'Accept': ', '.join( content_types()),
+		'Accept-Encoding': ', '.join( ENCODINGS),
+	}
+	if content is not None:
+		headers[ 'Content-Type'] = TYPE_JSON
+		if len( content) >= COMPRESS_MIN:
+			content = compress( content, 'gzip')
+			headers[ 'Content-Encoding'] = 'gzip'
+	try:
+		status, response_headers, s = pool.request( address, method, path, content, headers)
+		encoding = response_headers.getheader( 'Content-Encoding')
+		if encoding:
+			s = decompress( s, encoding)
+	except (httplib.HTTPException, socket.error, ValueError):
+		_logger.debug( '    %s %s%s: %s', method, address, path, sys.exc_info()[1])
+		return None, None, None
+	return status, s, response_headers.gettype()
+
+
 def push( address, content):
 	"""Pushes the content given via HTTP PUT to update the remote
 	instance.
@@ -37,18 +209,10 @@ def push( address, content):
 	Retruns:
 		True if successful
 	"""
-	url = _url( address, '/copy')
-	opener = urllib2.build_opener( urllib2.HTTPHandler)
-	request = urllib2.Request( url, data=content)
-	request.add_header( 'Content-Type', 'application/json')
-	request.get_method = lambda: 'PUT'
-	try:
-		url = opener.open( request)
-	except:
-		_logger.warning( 'Cannot PUT data to %s: %s', url, sys.exc_info()[0])
-		_logger.warning( '%s', ''.join( traceback.format_tb( sys.exc_info()[2])))
+	status, _, _ = _request( address, 'PUT', '/copy', content)
+	if status is None or status >= 300:
+		_logger.warning( 'Cannot PUT data to %s: %s', _url( address, '/copy'), status)
 		return False
-		
 	return True
 
 
@@ -64,47 +228,120 @@ def push_state( address, content):
 	Retruns:
 		True if successful
 	"""
-	url = _url( address, '/state')
-	opener = urllib2.build_opener( urllib2.HTTPHandler)
-	request = urllib2.Request( url, data=content)
-	request.add_header( 'Content-Type', 'application/json')
-	request.get_method = lambda: 'PUT'
-	try:
-		url = opener.open( request)
-	except:
-		_logger.warning( 'Cannot PUT data to %s: %s', url, sys.exc_info()[0])
-		_logger.warning( '%s', ''.join( traceback.format_tb( sys.exc_info()[2])))
+	status, _, _ = _request( address, 'PUT', '/state', content)
+	if status is None or status >= 300:
+		_logger.warning( 'Cannot PUT data to %s: %s', _url( address, '/state'), status)
 		return False
-		
 	return True
 
 
-def get( address, path):
-	url = _url( address, path)
+def _fetch( address, path):
+	"""Retrieves the resource given.
+
+	Returns:
+		Content and its type or None, None if not successful
+	"""
+	status, s, content_type = _request( address, 'GET', path)
+	if status != 200:
+		return None, None
+	return s, content_type
+
+
+def exchange( address, content):
+	"""Sends our state to the instance given and receives its state by
+	a single POST to /exchange.
+
+	Args:
+		address: destination
+		content: our version and cluster state encoded as JSON
+	Returns:
+		HTTP status and decoded response, None if not available
+	"""
+	status, s, content_type = _request( address, 'POST', '/exchange', content)
+	if status != 200:
+		return status, None
 	try:
-		f = urllib2.urlopen( url)
-		s = f.read()
-		return s
-	except urllib2.URLError:
-		_logger.debug( '    %s: %s', url, sys.exc_info()[1])
+		return status, decode( s, content_type)
+	except ValueError:
+		_logger.warning( 'Invalid content from %s/exchange', address)
+		return status, None
+
+
+def get( address, path):
+	s, _ = _fetch( address, path)
+	return s
+
+
+def _fetch_decoded( address, path):
+	s, content_type = _fetch( address, path)
+	if s is None:
 		return None
-	except:
-		_logger.warning( 'Cannot GET data from %s: %s %s', url, sys.exc_info()[0], sys.exc_info()[1])
-		_logger.warning( '%s', ''.join( traceback.format_tb( sys.exc_info()[2])))
+	try:
+		return decode( s, content_type)
+	except ValueError:
+		_logger.warning( 'Invalid content from %s%s', address, path)
 		return None
 
 
 def info( address):
-	str_info = get( address, "/state")
-	if str_info is None:
-		return None
-	return json.loads( str_info)
+	return _fetch_decoded( address, "/state")
 
-def pull( address):
-	s = get( address, "/copy")
-	if s is None:
+def pull( address, base=None):
+	"""Pulls data from the instance given.
+
+	Args:
+		address: source
+		base: version we have, only changes since then are pulled if the
+			other side knows it
+	"""
+	path = "/copy"
+	if base is not None:
+		path += "?sequence=%s&checksum=%s"%( base.sequence, base.checksum)
+	return _fetch_decoded( address, path)
+
+
+def compress( content, encoding):
+	"""Compresses the content given using the HTTP content encoding given."""
+	if encoding == 'gzip':
+		compressor = zlib.compressobj( 6, zlib.DEFLATED, 16 +zlib.MAX_WBITS)
+		return compressor.compress( content) +compressor.flush()
+	elif encoding == 'deflate':
+		return zlib.compress( content, 6)
+	raise ValueError( 'Unknown encoding %s'%encoding)
+
+
+def decompress( content, encoding):
+	"""Decompresses the content given using the HTTP content encoding given.
+
+	Raises ValueError if the encoding is unknown or content is invalid.
+	"""
+	encoding = encoding.strip().lower()
+	try:
+		if encoding == 'gzip':
+			return zlib.decompress( content, 16 +zlib.MAX_WBITS)
+		elif encoding == 'deflate':
+			return zlib.decompress( content)
+		elif encoding == 'identity':
+			return content
+	except zlib.error, e:
+		raise ValueError( str( e))
+	raise ValueError( 'Unknown encoding %s'%encoding)
+
+
+def decompressor( encoding):
+	"""Returns an object decompressing content of the HTTP content encoding
+	given incrementally or None for identity.
+
+	Raises ValueError if the encoding is unknown.
+	"""
+	encoding = encoding.strip().lower()
+	if encoding == 'gzip':
+		return zlib.decompressobj( 16 +zlib.MAX_WBITS)
+	elif encoding == 'deflate':
+		return zlib.decompressobj()
+	elif encoding == 'identity':
 		return None
-	return json.loads( s)
+	raise ValueError( 'Unknown encoding %s'%encoding)
 
 
 def normalize_addr( addr):
@@ -146,6 +383,96 @@ def now():
 def load_json( s):
 	return json.loads( s)
 
+def content_types():
+	"""Returns content types we can encode and decode, preferred first."""
+	if msgpack is not None:
+		return [TYPE_MSGPACK, TYPE_JSON]
+	return [TYPE_JSON]
+
+
+def parse_qualities( header):
+	"""Parses an Accept or Accept-Encoding header.
+
+	Returns:
+		Dictionary of lowercase values and their qualities, 1.0 by default
+		and 0.0 if invalid
+	"""
+	qualities = {}
+	for item in (header or '').split( ','):
+		params = item.split( ';')
+		if not params[0].strip():
+			continue
+		quality = 1.0
+		for param in params[1:]:
+			name, _, value = param.partition( '=')
+			if name.strip() == 'q':
+				try:
+					quality = float( value)
+				except ValueError:
+					quality = 0.0
+		qualities[ params[0].strip().lower()] = quality
+	return qualities
+
+
+def negotiate_type( accept):
+	"""Selects content type of a response from the Accept header given.
+
+	JSON is selected unless the binary encoding is available and preferred.
+	"""
+	if not accept or msgpack is None:
+		return TYPE_JSON
+	qualities = parse_qualities( accept)
+	json_quality = max( qualities.get( TYPE_JSON, 0.0), qualities.get( '*/*', 0.0))
+	if qualities.get( TYPE_MSGPACK, 0.0) > 0.0 and qualities[ TYPE_MSGPACK] >= json_quality:
+		return TYPE_MSGPACK
+	return TYPE_JSON
+
+
+def negotiate_encoding( accept_encoding):
+	"""Returns the preferred content encoding of ENCODINGS accepted by the
+	Accept-Encoding header given or None."""
+	qualities = parse_qualities( accept_encoding)
+	for encoding in ENCODINGS:
+		if qualities.get( encoding, 0.0) > 0.0:
+			return encoding
+	return None
+
+
+def encode( data, content_type=TYPE_JSON, pretty=False):
+	""" Converts the data given for transfer.
+
+	JSON is compact unless pretty output is requested. Checksums do not
+	depend on this form, see data.hash_tree.
+
+	Args:
+		data: Data for conversion
+		content_type: TYPE_JSON or TYPE_MSGPACK
+		pretty: indent JSON
+	"""
+	if content_type == TYPE_MSGPACK:
+		# Strings of Python 2 are text, they must not become binary
+		return msgpack.packb( data, use_bin_type=False)
+	if pretty:
+		return dump_json( data)
+	return json.dumps( data, sort_keys=True, separators=(',', ':'), check_circular=False)
+
+
+def decode( content, content_type=TYPE_JSON):
+	""" Converts the transferred content given to data.
+
+	Content of other types than the binary one is considered to be JSON.
+	Raises ValueError if the content is invalid or cannot be decoded.
+	"""
+	if content_type != TYPE_MSGPACK:
+		return json.loads( content)
+	if msgpack is None:
+		raise ValueError( 'Binary encoding is not available')
+	try:
+		return msgpack.unpackb( content, raw=False)
+	except Exception, e:
+		raise ValueError( str( e))
+
+
 def dump_json( data):
 	""" Converts the configuration into human-readable string.
 	
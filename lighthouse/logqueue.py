@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+"""Logging off the request threads.
+
+Log records are put into a bounded queue and formatted and written by
+a background thread. Records are dropped rather than blocking the caller
+if the writer falls behind.
+
+"""
+
+# System imports
+import logging
+import threading
+import Queue
+
+# Maximal number of records waiting to be written
+QUEUE_SIZE = 4096
+# Maximal number of characters of logged payloads
+PAYLOAD_MAX = 256
+
+
+class QueueHandler( logging.Handler):
+	"""Passes records to a background thread writing them by the handler
+	given.
+
+	Public instance attributes:
+		dropped: number of records dropped because the queue was full
+	"""
+
+	def __init__(self, target, size=QUEUE_SIZE):
+		logging.Handler.__init__( self)
+		self.target = target
+		self.dropped = 0
+		self._records = Queue.Queue( size)
+		writer = threading.Thread( target=self._write, name='Log writer')
+		writer.setDaemon( True)
+		writer.start()
+
+	def emit(self, record):
+		# Keep the record free of the traceback, it cannot be formatted later
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException( record.exc_info)
+			record.exc_info = None
+		try:
+			self._records.put_nowait( record)
+		except Queue.Full:
+			self.dropped += 1
+
+	def _write(self):
+		while True:
+			record = self._records.get()
+			try:
+				self.target.handle( record)
+			except Exception:
+				self.target.handleError( record)
+			self._records.task_done()
+
+	def flush(self):
+		"""Waits until queued records are written."""
+		self._records.join()
+		self.target.flush()
+
+
+class Payload:
+	"""Wraps content to log, it is converted and shortened only if the
+	record is written.
+	"""
+
+	def __init__(self, content, size=PAYLOAD_MAX):
+		self.content = content
+		self.size = size
+
+	def __str__(self):
+		s = self.content
+		if isinstance( s, unicode):
+			s = s.encode( 'utf-8')
+		else:
+			s = str( s)
+		if len( s) <= self.size:
+			return s
+		return '%s... (%s characters)'%( s[ :self.size], len( s))
+
+
+def install( level, format, datefmt=None):
+	"""Sets up the root logger to write records to stderr asynchronously.
+
+	Returns:
+		The queue handler installed
+	"""
+	target = logging.StreamHandler()
+	target.setFormatter( logging.Formatter( format, datefmt))
+	handler = QueueHandler( target)
+	root = logging.getLogger()
+	for old in list( root.handlers):
+		root.removeHandler( old)
+	root.addHandler( handler)
+	root.setLevel( level)
+	return handler
@@ -14,10 +14,12 @@ import logging
 
 # Local imports
 import server
+import eventloop
 import sync
 import config
 import data
 import helpers
+import logqueue
 
 from __init__ import __version__
 from __init__ import SERVER_NAME
@@ -36,6 +38,23 @@ USAGE = """
 --rm-limit=
 --bootstrap
 --bootstrap-limit=
+--history-size=   number of recent versions kept in memory
+--history-bytes=  estimated size of recent versions kept in memory
+--workers=        number of threads handling requests
+--queue-size=     maximal number of connections waiting for a thread
+--keepalive-timeout=  time after an idle connection is closed in seconds
+--engine=         server engine, threaded (default) or eventloop
+--max-body=       maximal size of request content in bytes
+--max-reads=      maximal number of concurrent read requests
+--max-updates=    maximal number of concurrent update and lock requests
+--max-cluster=    maximal number of concurrent requests of other instances
+--log-level=      DEBUG, INFO (default), WARNING or ERROR
+--unix-socket=    path of a Unix domain socket to listen on as well,
+                  --bind= with no address disables the TCP listener
+--unix-socket-mode=  permissions of the socket in octal, 0660 by default
+--gossip-fanout=  number of instances contacted by a gossip round, 0 (default)
+                  to contact all instances continuously
+--gossip-period=  period of gossip rounds in seconds
 """
 
 # Exit codes
@@ -46,6 +65,11 @@ EXIT_ERR = 2  # Error
 # Log entry format
 LOG_FORMAT = "%(asctime)s.%(msecs)d %(name)-10s %(levelname)-8s %(message)s"
 
+# Server engines
+ENGINE_THREADED = 'threaded'
+ENGINE_EVENTLOOP = 'eventloop'
+ENGINES = [ENGINE_THREADED, ENGINE_EVENTLOOP]
+
 # Default limits for remove of conf files and for delayed startup
 DEF_LOAD_LIMIT = '-7 days'
 DEF_RM_LIMIT = '-7 days'
@@ -67,9 +91,9 @@ def print_usage( version_only=False):
 
 
 if __name__ == '__main__':
-	logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT, datefmt="%Y-%m-%d %H:%M:%S")
+	logqueue.install( logging.INFO, LOG_FORMAT, datefmt="%Y-%m-%d %H:%M:%S")
 	try:
-		optlist, args = getopt.gnu_getopt( sys.argv[1:], '', 'help version data.d= seeds= bind= load-limit= rm-limit= bootstrap bootstrap-limit='.split())
+		optlist, args = getopt.gnu_getopt( sys.argv[1:], '', 'help version data.d= seeds= bind= load-limit= rm-limit= bootstrap bootstrap-limit= history-size= history-bytes= workers= queue-size= keepalive-timeout= engine= max-body= max-reads= max-updates= max-cluster= log-level= unix-socket= unix-socket-mode= gossip-fanout= gossip-period='.split())
 	except getopt.GetoptError, err:
 		die( 'Parameter error: ' +str( err))
 	bind = 'localhost:8001'
@@ -77,6 +101,18 @@ if __name__ == '__main__':
 	load_limit = DEF_LOAD_LIMIT
 	rm_limit = DEF_RM_LIMIT
 	bootstrap_limit = DEF_BOOTSTRAP_LIMIT
+	history_size = data.HISTORY_SIZE
+	history_bytes = data.HISTORY_BYTES
+	workers = server.WORKERS
+	queue_size = server.QUEUE_SIZE
+	keepalive_timeout = server.KEEPALIVE_TIMEOUT
+	engine = ENGINE_THREADED
+	max_body = server.MAX_BODY
+	limits = {}
+	unix_socket = None
+	unix_socket_mode = server.UNIX_SOCKET_MODE
+	gossip_fanout = sync.GOSSIP_FANOUT
+	gossip_period = sync.GOSSIP_PERIOD
 	for name, value in optlist:
 		if name == "--help":
 			print_usage()
@@ -96,18 +132,70 @@ if __name__ == '__main__':
 			bootstrap_limit = value
 		if name == "--rm-limit":
 			rm_limit = value
-
-	host, port = helpers.normalize_addr( bind)
-	if host is None:
-		die( 'Invalid binding address %s'%bind)
-
-	sync.init_cluster_state( '%s:%s'%(host, port))
+		if name == "--engine":
+			if value not in ENGINES:
+				die( 'Unknown engine %s'%value)
+			engine = value
+		if name == "--unix-socket":
+			unix_socket = value
+		if name == "--log-level":
+			level = logging.getLevelName( value.upper())
+			if not isinstance( level, int):
+				die( 'Unknown log level %s'%value)
+			logging.getLogger().setLevel( level)
+		try:
+			if name == "--history-size":
+				history_size = int( value)
+			if name == "--history-bytes":
+				history_bytes = int( value)
+			if name == "--workers":
+				workers = int( value)
+			if name == "--queue-size":
+				queue_size = int( value)
+			if name == "--keepalive-timeout":
+				keepalive_timeout = float( value)
+			if name == "--max-body":
+				max_body = int( value)
+			if name == "--max-reads":
+				limits[ server.ROUTE_READ] = int( value)
+			if name == "--max-updates":
+				limits[ server.ROUTE_UPDATE] = int( value)
+			if name == "--max-cluster":
+				limits[ server.ROUTE_CLUSTER] = int( value)
+			if name == "--unix-socket-mode":
+				unix_socket_mode = int( value, 8)
+			if name == "--gossip-fanout":
+				gossip_fanout = int( value)
+			if name == "--gossip-period":
+				gossip_period = float( value)
+		except ValueError:
+			die( 'Invalid value of %s: %s'%( name, value))
+
+	if bind:
+		host, port = helpers.normalize_addr( bind)
+		if host is None:
+			die( 'Invalid binding address %s'%bind)
+		bind_address = (host, port)
+		sync.init_cluster_state( '%s:%s'%(host, port), gossip_fanout, gossip_period)
+	elif unix_socket:
+		# Local instance only, not a member of any cluster
+		if seeds:
+			die( 'Seeds given without an address to bind')
+		bind_address = None
+		sync.init_cluster_state( None, 0, gossip_period)
+	else:
+		die( 'No address to listen on')
+
+	if engine == ENGINE_EVENTLOOP and limits:
+		# Requests are not handled concurrently by the loop
+		die( '--max-reads, --max-updates and --max-cluster apply to the threaded engine only')
 
 	# FIXME avoid adding these seeds in cluster
 	for seed in seeds:
 		r = sync.cluster_state.add_instance( seed)
 
 	# Load old configuration
+	data.set_history_limits( size=history_size, size_bytes=history_bytes)
 	data.set_bootstrap_limit( bootstrap_limit=bootstrap_limit)
 	config.load_configuration( load_limit=load_limit)
 
@@ -115,5 +203,12 @@ if __name__ == '__main__':
 	config.set_rm_limit( rm_limit=rm_limit)
 	config.rm_old_files()
 	# Run the server
-	server.run( ( host, port))
+	if engine == ENGINE_EVENTLOOP:
+		eventloop.run( bind_address, keepalive_timeout=keepalive_timeout,
+				max_body=max_body, limits=limits,
+				unix_socket=unix_socket, unix_socket_mode=unix_socket_mode)
+	else:
+		server.run( bind_address, workers=workers, queue_size=queue_size,
+				keepalive_timeout=keepalive_timeout, max_body=max_body, limits=limits,
+				unix_socket=unix_socket, unix_socket_mode=unix_socket_mode)
 
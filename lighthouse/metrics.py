@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+"""Counters and histograms exported in Prometheus text format.
+
+Recording takes a single short lock and does not allocate for known label
+sets, so it is always on. Metrics are identified by name and a tuple of
+label values, label names are described in METRICS.
+
+"""
+
+# System imports
+from __future__ import with_statement
+import bisect
+import threading
+import time
+
+# Upper bounds of duration buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Content type of the text format
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Known metrics: name -> (type, label names, description)
+METRICS = {
+	'lighthouse_requests_total': ('counter', ('route', 'method', 'status'),
+		'Requests handled'),
+	'lighthouse_request_duration_seconds': ('histogram', ('route', 'method', 'status'),
+		'Time to handle a request'),
+	'lighthouse_received_bytes_total': ('counter', ('route',),
+		'Request content received'),
+	'lighthouse_sent_bytes_total': ('counter', ('route',),
+		'Response content sent'),
+	'lighthouse_serialization_duration_seconds': ('histogram', (),
+		'Time to serialize and compress a response'),
+	'lighthouse_sequence': ('gauge', (),
+		'Sequence of the current data version'),
+	'lighthouse_commits_total': ('counter', (),
+		'Data versions made current'),
+	'lighthouse_peer_pushes_total': ('counter', ('peer', 'result'),
+		'Pushes of data to other instances'),
+	'lighthouse_peer_push_duration_seconds': ('histogram', ('peer',),
+		'Time to push data to another instance'),
+	'lighthouse_peer_pulls_total': ('counter', ('peer', 'result'),
+		'Pulls of data from other instances'),
+	'lighthouse_peer_pull_duration_seconds': ('histogram', ('peer',),
+		'Time to pull data from another instance'),
+	'lighthouse_snapshot_duration_seconds': ('histogram', (),
+		'Time to write a data snapshot'),
+	'lighthouse_convergence_seconds': ('histogram', (),
+		'Time since a version became current until all reachable instances had it'),
+}
+
+_lock = threading.Lock()
+# (name, labels) -> value
+_counters = {}
+_gauges = {}
+# (name, labels) -> [bucket counts, sum, count]
+_histograms = {}
+
+
+def inc( name, labels=(), value=1):
+	"""Increments the counter given."""
+	key = (name, labels)
+	with _lock:
+		_counters[ key] = _counters.get( key, 0) +value
+
+
+def set_gauge( name, value, labels=()):
+	"""Sets the gauge given."""
+	with _lock:
+		_gauges[ (name, labels)] = value
+
+
+def observe( name, value, labels=()):
+	"""Records an observation of the histogram given."""
+	key = (name, labels)
+	with _lock:
+		histogram = _histograms.get( key)
+		if histogram is None:
+			histogram = _histograms[ key] = [[0]*(len( BUCKETS) +1), 0.0, 0]
+		histogram[0][ bisect.bisect_left( BUCKETS, value)] += 1
+		histogram[1] += value
+		histogram[2] += 1
+
+
+class Timer:
+	"""Records duration of a block into the histogram given.
+
+	Usage:
+		with metrics.Timer( 'lighthouse_snapshot_duration_seconds'):
+			...
+	"""
+
+	def __init__(self, name, labels=()):
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		observe( self.name, time.time() -self.start, self.labels)
+		return False
+
+
+def reset():
+	"""Forgets all recorded values."""
+	with _lock:
+		_counters.clear()
+		_gauges.clear()
+		_histograms.clear()
+
+
+def _escape( value):
+	return str( value).replace( '\\', '\\\\').replace( '"', '\\"').replace( '\n', '\\n')
+
+
+def _labels( name, values, extra=()):
+	pairs = zip( METRICS[ name][1], values) +list( extra)
+	if not pairs:
+		return ''
+	return '{%s}'%','.join( ['%s="%s"'%(label, _escape( value)) for label, value in pairs])
+
+
+def _number( value):
+	if isinstance( value, float):
+		return repr( value)
+	return str( value)
+
+
+def render():
+	"""Returns all metrics in Prometheus text format."""
+	with _lock:
+		counters = _counters.items()
+		gauges = _gauges.items()
+		histograms = [(key, (list( h[0]), h[1], h[2])) for key, h in _histograms.iteritems()]
+
+	by_name = {}
+	for (name, labels), value in counters +gauges +histograms:
+		by_name.setdefault( name, []).append( (labels, value))
+
+	lines = []
+	for name in sorted( by_name):
+		kind, _, description = METRICS[ name]
+		lines.append( '# HELP %s %s'%(name, description))
+		lines.append( '# TYPE %s %s'%(name, kind))
+		for labels, value in sorted( by_name[ name]):
+			if kind != 'histogram':
+				lines.append( '%s%s %s'%(name, _labels( name, labels), _number( value)))
+				continue
+			buckets, total, count = value
+			cumulative = 0
+			for bound, bucket in zip( BUCKETS +('+Inf',), buckets):
+				cumulative += bucket
+				lines.append( '%s_bucket%s %s'%(name, _labels( name, labels, [('le', bound)]), cumulative))
+			lines.append( '%s_sum%s %s'%(name, _labels( name, labels), repr( total)))
+			lines.append( '%s_count%s %s'%(name, _labels( name, labels), count))
+	return '\n'.join( lines) +'\n'
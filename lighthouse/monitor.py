@@ -1,11 +1,17 @@
 
 # System imports
+from __future__ import with_statement
 import threading
 import logging
 import random
 import sys
 import time
 import traceback
+import heapq
+import itertools
+import collections
+import math
+import Queue
 
 # Local imports
 import sync
@@ -13,18 +19,208 @@ import helpers
 import inlock
 import data
 import config
+import metrics
 
 _logger = logging.getLogger(__name__)
 
 # Period between pings in seconds
 PING_PERIOD = 0.5
+# Longest period between pings of an instance with unchanged version
+PING_PERIOD_STABLE = 5.0
+# Longest period between pings of an unreachable instance
+PING_PERIOD_BACKOFF = 30.0
+# Factor the period grows by with every ping of an unchanged instance
+PING_RELAX = 1.5
+# Number of heartbeat delays kept per instance
+HEARTBEAT_HISTORY = 100
+# Suspicion level above which the instance is considered unreachable
+PHI_THRESHOLD = 8.0
+# Lower bound of the deviation of heartbeat delays in seconds
+PHI_MIN_DEVIATION = 0.2
+# Delay in seconds tolerated on top of the mean heartbeat delay
+PHI_PAUSE = 1.0
 # Maximal delay for push/pull operation
 REACTION_VAR = 0.01
+# Minimal and maximal number of threads running cycles of all monitors, one
+# is started for every monitor in between, so that instances not responding
+# do not hold all of them
+WORKERS = 4
+MAX_WORKERS = 64
+# Statuses of instances not supporting /exchange
+EXCHANGE_UNSUPPORTED = (404, 405, 501)
 
-class Monitor(threading.Thread):
+
+class Scheduler:
+	"""Runs update cycles of all monitors by worker threads.
+
+	Monitors wait in a heap ordered by time of their next cycle. The
+	scheduler thread hands due monitors to workers. A monitor is never run
+	by two workers at once, a push requested meanwhile is done by its next
+	cycle. Workers are added with monitors up to the maximum given.
+	"""
+
+	def __init__(self, workers=WORKERS, max_workers=MAX_WORKERS):
+		self.workers = workers
+		self.max_workers = max_workers
+		# Number of monitors added and of worker threads started
+		self._monitors = 0
+		self._threads = 0
+		self._condition = threading.Condition()
+		# (time, order, monitor), entries of rescheduled monitors are stale
+		self._heap = []
+		self._order = itertools.count()
+		# Due monitors waiting for a worker
+		self._ready = Queue.Queue()
+		self._started = False
+		self._stopped = False
+
+	def add(self, monitor):
+		"""Schedules the first cycle of the monitor given at once."""
+		self._start()
+		with self._condition:
+			self._monitors += 1
+			wanted = min( max( self.workers, self._monitors), self.max_workers)
+			first = self._threads
+			self._threads = max( wanted, first)
+		self._start_workers( first, self._threads)
+		self.schedule( monitor, time.time())
+
+	def schedule(self, monitor, due):
+		"""Schedules the next cycle of the monitor given, an earlier time
+		already scheduled is kept. No cycle is scheduled if due is None."""
+		if due is None:
+			return
+		with self._condition:
+			if monitor._running:
+				return
+			if monitor._due is not None and monitor._due <= due:
+				return
+			monitor._due = due
+			heapq.heappush( self._heap, (due, self._order.next(), monitor))
+			self._condition.notify()
+
+	def stop(self):
+		"""Stops the threads, cycles running are finished."""
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+
+	def _start(self):
+		with self._condition:
+			if self._started:
+				return
+			self._started = True
+		thread = threading.Thread( target=self._run, name='Scheduler')
+		thread.setDaemon( True)
+		thread.start()
+
+	def _start_workers(self, first, last):
+		"""Starts worker threads numbered from first to last, exclusive."""
+		for i in xrange( first, last):
+			thread = threading.Thread( target=self._work, name='Monitor %s'%i)
+			thread.setDaemon( True)
+			thread.start()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				monitor = self._pop_due()
+				while monitor is None and not self._stopped:
+					timeout = None
+					if self._heap:
+						timeout = max( self._heap[0][0] -time.time(), 0)
+					self._condition.wait( timeout)
+					monitor = self._pop_due()
+				if self._stopped:
+					threads = self._threads
+					break
+			self._ready.put( monitor)
+		for i in xrange( threads):
+			self._ready.put( None)
+
+	def _pop_due(self):
+		"""Returns a monitor due to run or None. Must be called with the
+		condition held."""
+		now = time.time()
+		while self._heap and self._heap[0][0] <= now:
+			due, _, monitor = heapq.heappop( self._heap)
+			if monitor._due != due:
+				continue
+			monitor._due = None
+			monitor._running = True
+			return monitor
+		return None
+
+	def _work(self):
+		while True:
+			monitor = self._ready.get()
+			if monitor is None:
+				return
+			try:
+				monitor.cycle()
+			except:
+				_logger.error( 'Unhandled exception %s', sys.exc_info()[0])
+				_logger.error( '%s', ''.join( traceback.format_tb( sys.exc_info()[2])))
+			with self._condition:
+				monitor._running = False
+			self.schedule( monitor, monitor.next_cycle())
+
+
+class FailureDetector:
+	"""Phi accrual failure detector.
+
+	Heartbeats (successful pings) follow the ping period, which changes.
+	So the detector keeps delays of recent heartbeats after the time they
+	were expected, and tells how suspicious the delay of the next one is
+	now. Phi of 1 means about 10% chance of a mistake in considering the
+	instance down, phi of 2 about 1% and so on. Not synchronized, the
+	monitor holds its lock.
+	"""
+
+	def __init__(self, size=HEARTBEAT_HISTORY):
+		self._delays = collections.deque( maxlen=size)
+		self._last = None
+		# Time after the last heartbeat the next one is expected
+		self._expected = 0.0
+
+	def heartbeat(self, now, expected, record=True):
+		"""Notes a heartbeat.
+
+		Args:
+			now: time of the heartbeat
+			expected: time after this heartbeat the next one is expected
+			record: if False, the delay of this heartbeat is not learnt,
+				e.g. after an outage
+		"""
+		if self._last is not None and record:
+			self._delays.append( now -self._last -self._expected)
+		self._last = now
+		self._expected = expected
+
+	def phi(self, now):
+		"""Returns the suspicion level or None if there was no heartbeat."""
+		if self._last is None:
+			return None
+		mean, deviation = 0.0, 0.0
+		if self._delays:
+			mean = sum( self._delays) /len( self._delays)
+			deviation = math.sqrt( sum( [(x -mean)**2 for x in self._delays]) /len( self._delays))
+		deviation = max( deviation, PHI_MIN_DEVIATION)
+		# Logistic approximation of the normal distribution, the probability
+		# of a heartbeat later than now is kept in logarithm
+		y = (now -self._last -self._expected -mean -PHI_PAUSE) /deviation
+		y = max( y, -10.0)
+		exponent = -y *(1.5976 +0.070566 *y *y)
+		if y > 0:
+			return max( 0.0, (math.log1p( math.exp( exponent)) -exponent) /math.log( 10))
+		return -math.log10( 1.0 -1.0 /(1.0 +math.exp( exponent)))
+
+
+class Monitor:
 	"""Monitors the instance given for updates.
 
-	Runs in its own thread. It follows the ping/pull/push pattern.
+	Its cycles are run by the scheduler. It follows the ping/pull/push
+	pattern.
 
 	Information about monitored instance is accessed cuncurrently by a
 	thread collecting states of all instances.
@@ -33,19 +229,24 @@ class Monitor(threading.Thread):
 		address: address of the monitored instance, immutable
 	"""
 
-	def __init__(self, address):
+	def __init__(self, address, gossip=False):
 		"""Initializes the monitor with instance state given.
 
 		Args:
 			address: address of the instance to monitor
+			gossip: if True, the instance is pinged only when chosen for
+				a gossip round
 		"""
-		# Initialize the thread as daemon
-		super(Monitor, self).__init__(name="Monitor %s"%address)
-		self.setDaemon( True)
 		inlock.add_lock( self)
-			
+		self.gossip = gossip
+
 		# Asynchronous communicaton - push request
-		self.force_push = threading.Event()
+		self._push_requested = False
+		# Time of the next cycle and if a cycle runs, managed by Scheduler
+		self._due = None
+		self._running = False
+		# If the instance answers /exchange, older ones do not
+		self._exchange = True
 			
 		# Instance information
 			
@@ -55,8 +256,11 @@ class Monitor(threading.Thread):
 
 		# Last version of the instance data as reported (instance of DataVersion or None)
 		self._version = data.DataVersion()
-		# If last ping successed
-		self._reachable = False
+		# Suspicion of the instance being down, fed by successful pings
+		self._detector = FailureDetector()
+		# Current period between pings and number of failed pings in a row
+		self._interval = PING_PERIOD
+		self._failures = 0
 		# Time of the last successful ping (DateTime)
 		self._last_reachable = helpers.NOTIME
 		# Time of the last successful push (DateTime)
@@ -69,39 +273,66 @@ class Monitor(threading.Thread):
 		if self._version >= xdata.version:
 			return
 
-		# Push data
-		_logger.info( '%s Push', self.address)
-		result = helpers.push( self.address, helpers.dump_json({
-				'version': {
-					'sequence': xdata.version.sequence,
-					'checksum': xdata.version.checksum,
-				},
-				'data': xdata.data,
-			}))
-
-		_logger.info('push result: %s', result)
+		# Push changes if the other instance has a version we know
+		result = False
+		started = time.time()
+		delta = data.get_delta( self._version)
+		if delta is not None:
+			_logger.info( '%s Push patch', self.address)
+			result = helpers.push( self.address, helpers.encode( delta))
+
+		# Push complete data otherwise
+		if not result:
+			_logger.info( '%s Push', self.address)
+			result = helpers.push( self.address, helpers.encode({
+					'version': {
+						'sequence': xdata.version.sequence,
+						'checksum': xdata.version.checksum,
+					},
+					'data': xdata.data,
+				}))
+		metrics.observe( 'lighthouse_peer_push_duration_seconds', time.time() -started, (self.address,))
+		metrics.inc( 'lighthouse_peer_pushes_total', (self.address, result and 'ok' or 'failed'))
+
+		_logger.debug( '%s Push result: %s', self.address, result)
 		# Mark time when we tried to push new data
 		if result:
-			self._touch_last_push()
+			self._touch_last_push( xdata.version)
+			sync.cluster_state.check_converged()
 
 	def _pull(self):
 		# Ping the instance and get its version
-		_logger.info( '%s Ping', self.address)
+		_logger.debug( '%s Ping', self.address)
 
-#		_logger.info( "dump_json: %s", sync.cluster_state.get_state() + [{'address': sync.cluster_state.me}])
-		# Try to push your state to the other side
-		helpers.push_state( self.address, helpers.dump_json( sync.cluster_state.get_state() + [{'address': sync.cluster_state.me}]))
+		cluster = sync.cluster_state.get_members()
+		if self._exchange:
+			# Send our state and get the other one by a single request
+			status, info = helpers.exchange( self.address, helpers.encode({
+					'version': data.cur_data().version.to_dict(),
+					'cluster': cluster,
+				}))
+			if status in EXCHANGE_UNSUPPORTED:
+				_logger.info( '%s Exchange not supported', self.address)
+				self._exchange = False
+		if not self._exchange:
+			# Try to push your state to the other side
+			helpers.push_state( self.address, helpers.encode( cluster))
+			info = helpers.info( self.address)
 
-		info = helpers.info( self.address)
 		if not info:
-			self._reachable = False
+			self._touch_unreachable()
 			return
 		try:
-			self._version = data.DataVersion.from_dict( info[ 'version'])
+			version = data.DataVersion.from_dict( info[ 'version'])
 		except (TypeError, KeyError):
 			_logger.error( '%s Invalid pulled data', self.address)
 			return
-		self._touch_last_reachable()
+		self._touch_last_reachable( version)
+		sync.cluster_state.check_converged()
+
+		# Gossip both ways, push if the other instance is behind
+		if self.gossip and self._version < data.cur_data().version:
+			return self._push()
 
 		# Check that the other instance has newer configuration
 		if self._version <= data.cur_data().version:
@@ -110,54 +341,125 @@ class Monitor(threading.Thread):
 		# The instance has newer configuration, try to pull it
 		_logger.info( '%s Pull', self.address)
 
-		content = helpers.pull( self.address)
+		started = time.time()
+		result = self._pull_data( info.get( 'copy'))
+		metrics.observe( 'lighthouse_peer_pull_duration_seconds', time.time() -started, (self.address,))
+		metrics.inc( 'lighthouse_peer_pulls_total', (self.address, result and 'ok' or 'failed'))
+
+	def _pull_data(self, content=None):
+		"""Pulls newer data from the other instance.
+
+		Args:
+			content: data already received by the exchange, if any
+		Returns:
+			True if the data pulled are current
+		"""
 		if content is None:
+			content = helpers.pull( self.address, data.cur_data().version)
+		if not isinstance( content, dict):
 			return False
 		# Check in new data
 		if data.push_data( content):
 			config.save_configuration()
+			sync.cluster_state.forward()
+			return True
+		elif 'patch' in content:
+			# The patch is not applicable, pull complete data
+			content = helpers.pull( self.address)
+			if content is not None and data.push_data( content):
+				config.save_configuration()
+				sync.cluster_state.forward()
+				return True
+		return False
+
+	def force_push(self):
+		"""Requests the current data to be pushed to the instance soon."""
+		self._request_push( True)
+		# Wait little bit to avoid update storms
+		scheduler.schedule( self, time.time() +random.random() *REACTION_VAR)
+
+	@inlock.synchronized
+	def _request_push(self, requested):
+		"""Sets the push request, returns the previous one."""
+		previous = self._push_requested
+		self._push_requested = requested
+		return previous
 
-	def _cycle(self):
+	def exchange(self):
+		"""Requests a ping of the instance soon, data are pushed or pulled
+		if versions differ."""
+		scheduler.schedule( self, time.time())
+
+	def next_cycle(self):
+		"""Returns time of the next cycle or None if there is none."""
+		if self._push_requested:
+			return time.time() +random.random() *REACTION_VAR
+		if self.gossip:
+			return None
+		return time.time() +self._interval
+
+	def cycle(self):
 		"""One update cycle.
-		
-		It consists of pull or push request.
+
+		It consists of push if requested, ping and pull otherwise.
 		"""
-		# Wait for push signal or timeout
-		do_push = self.force_push.wait( PING_PERIOD)
-		self.force_push.clear()
-		# Wait little bit more to avoid update storms
-		time.sleep( random.random() *REACTION_VAR)
-		# Perform the action
-		if do_push:
+		if self._request_push( False):
 			self._push()
 		else:
 			self._pull()
 
-	def run(self):
-		"""Runs the cycle ping/pull/push.
-		"""
-		while True:
-			try:
-				self._cycle()
-			except:
-				_logger.error( 'Unhandled exception %s', sys.exc_info()[0])
-				_logger.error( '%s', ''.join( traceback.format_tb( sys.exc_info()[2])))
-
 	@inlock.synchronized
-	def _touch_last_push(self):
+	def _touch_last_push(self, version):
+		self._version = version
 		self._last_push = helpers.now()
+		self._interval = PING_PERIOD
 
 	@inlock.synchronized
-	def _touch_last_reachable(self):
-		self._reachable = True
+	def known_version(self):
+		"""Returns the last version of the instance known and whether it
+		is reachable."""
+		return self._version, self._is_reachable( time.time())
+
+	def _is_reachable(self, now):
+		phi = self._detector.phi( now)
+		return phi is not None and phi < PHI_THRESHOLD
+
+	@inlock.synchronized
+	def _touch_last_reachable(self, version):
+		"""Notes a successful ping. The instance is pinged at a relaxed
+		rate while its version stays the same as ours."""
+		if version == self._version and version == data.cur_data().version:
+			self._interval = min( self._interval *PING_RELAX, PING_PERIOD_STABLE)
+		else:
+			self._interval = PING_PERIOD
+		# The next heartbeat is expected after the period
+		self._detector.heartbeat( time.time(), self._interval, not self._failures)
+		self._failures = 0
+		self._version = version
 		self._last_reachable = helpers.now()
 
+	@inlock.synchronized
+	def _touch_unreachable(self):
+		"""Notes a failed ping, pings back off exponentially."""
+		self._failures += 1
+		self._interval = min( PING_PERIOD *2**self._failures, PING_PERIOD_BACKOFF)
+
 	@inlock.synchronized
 	def to_dict(self):
+		now = time.time()
+		phi = self._detector.phi( now)
+		if phi is not None:
+			phi = round( phi, 2)
 		return {
 			'address': self.address,
 			'version': self._version.to_dict(),
-			'reachable': self._reachable,
+			'reachable': self._is_reachable( now),
+			'phi': phi,
+			'ping-period': self._interval,
 			'last-reachable': helpers.dump_time( self._last_reachable),
 			'last-push': helpers.dump_time( self._last_push),
 		}
+
+
+# Scheduler of all monitors
+scheduler = Scheduler()
@@ -13,11 +13,18 @@ import BaseHTTPServer
 import SocketServer
 import _json as json
 import sys
+import os
+import stat
+import errno
 import logging
 import threading
 import socket
 import time
 import urlparse
+import Queue
+import collections
+import select
+import zlib
 
 # Local imports
 from __init__ import SERVER_NAME
@@ -26,6 +33,9 @@ import data
 import sync
 import helpers
 import config
+import inlock
+import metrics
+import logqueue
 
 
 RESPONSE_ABOUT = """
@@ -51,6 +61,14 @@ RESPONSE_BAD_REQUEST = 'Bad Request'
 RESPONSE_INV_LOCK_CODE = 'Invalid Lock Code'
 RESPONSE_CREATED = 'Created'
 RESPONSE_SERVICE_UNAVAILABLE = 'Service Unavailable'
+RESPONSE_UNKNOWN_BASE = 'Unknown Base Version'
+RESPONSE_UNKNOWN_VERSION = 'Unknown Version'
+RESPONSE_TOO_LARGE = 'Request Entity Too Large'
+RESPONSE_TIMEOUT = 'Request Timeout'
+# Sent by the poller if no worker can take the request
+RESPONSE_QUEUE_FULL = 'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n' \
+	'Content-Length: %s\r\nRetry-After: %%s\r\nConnection: close\r\n\r\n%s'%(
+	len( RESPONSE_SERVICE_UNAVAILABLE), RESPONSE_SERVICE_UNAVAILABLE)
 
 # URLs
 
@@ -60,9 +78,178 @@ U_UPDATE = '/update'
 U_LOCK = '/lock'
 U_COPY = '/copy'
 U_STATE = '/state'
-
+U_DIFF = '/diff'
+U_BATCH = '/batch'
+U_TRANSACTION = '/transaction'
+U_METRICS = '/metrics'
+U_EXCHANGE = '/exchange'
+# Resources requests are reported by in metrics
+ROUTES = [U_DATA, U_UPDATE, U_LOCK, U_COPY, U_STATE, U_DIFF, U_BATCH, U_TRANSACTION, U_METRICS, U_EXCHANGE]
+# Methods labelled in metrics, others are labelled 'other'
+METHODS = ['GET', 'HEAD', 'PUT', 'POST', 'DELETE']
+
+
+# Number of worker threads handling requests
+WORKERS = 64
+# Maximal number of accepted connections waiting for a worker
+QUEUE_SIZE = 256
+# Time after an idle persistent connection is closed in seconds
+KEEPALIVE_TIMEOUT = 15
+
+# Permissions of the Unix domain socket, owner and group may connect
+UNIX_SOCKET_MODE = 0660
+
+# Maximal size of request content in bytes, after decompression as well
+MAX_BODY = 16*1024*1024
+# Maximal time to receive the request line and headers in seconds
+HEADER_TIMEOUT = 5
+# Maximal time to receive request content in seconds
+BODY_TIMEOUT = 30
+# Size of blocks request content is read by
+READ_CHUNK = 65536
+
+# Route classes limited by admission control
+ROUTE_READ = 'read'
+ROUTE_UPDATE = 'update'
+ROUTE_CLUSTER = 'cluster'
+ROUTE_WAIT = 'wait'
+# Maximal number of requests of each class handled concurrently
+MAX_READS = 48
+MAX_UPDATES = 8
+MAX_CLUSTER = 8
+# Waiting requests hold a worker, at most half of workers may wait
+MAX_WAITS = WORKERS /2
+# Seconds after a shed request may be retried
+RETRY_AFTER = 1
+
+# Limits of cached response bodies
+BODY_CACHE_SIZE = 256
+BODY_CACHE_BYTES = 32*1024*1024
+
+# Default and maximal time to wait for a change of data in seconds
+WAIT_TIMEOUT = 30
+WAIT_TIMEOUT_MAX = 300
 
 _logger = logging.getLogger(__name__)
+# Access log, one record per request
+_access_logger = logging.getLogger('access')
+
+
+class BodyCache:
+	"""Keeps serialized and compressed response bodies.
+
+	Bodies are keyed by their ETag, which changes whenever the content does,
+	so cached bodies never become stale. The least recently used bodies are
+	dropped over limits.
+	"""
+
+	def __init__(self, size=BODY_CACHE_SIZE, size_bytes=BODY_CACHE_BYTES):
+		inlock.add_lock( self)
+		self.size = size
+		self.size_bytes = size_bytes
+		self._bodies = collections.OrderedDict()
+		self._bytes = 0
+
+	@inlock.synchronized
+	def get(self, key):
+		value = self._bodies.pop( key, None)
+		if value is not None:
+			self._bodies[ key] = value
+		return value
+
+	@inlock.synchronized
+	def put(self, key, value):
+		if key in self._bodies:
+			return
+		self._bodies[ key] = value
+		self._bytes += len( value[0])
+		while self._bodies and (len( self._bodies) > self.size or self._bytes > self.size_bytes):
+			_, old = self._bodies.popitem( last=False)
+			self._bytes -= len( old[0])
+
+# Response bodies of versioned content
+_bodies = BodyCache()
+
+
+class Admission:
+	"""Limits the number of concurrent requests of each route class.
+
+	Requests over the limit are not queued but refused at once, so that
+	a burst of one kind does not exhaust workers needed for the others.
+	"""
+
+	def __init__(self, limits):
+		inlock.add_lock( self)
+		self.limits = dict( limits)
+		self._active = dict( [(route, 0) for route in self.limits])
+		self._rejected = dict( [(route, 0) for route in self.limits])
+
+	@inlock.synchronized
+	def enter(self, route):
+		"""Admits the request of the route class given.
+
+		Returns:
+			True if admitted, leave() must be called then
+		"""
+		if self._active[ route] >= self.limits[ route]:
+			self._rejected[ route] += 1
+			return False
+		self._active[ route] += 1
+		return True
+
+	@inlock.synchronized
+	def leave(self, route):
+		self._active[ route] -= 1
+
+	@inlock.synchronized
+	def get_state(self):
+		"""Returns active and rejected requests of each route class."""
+		return dict( [(route, {
+			'active': self._active[ route],
+			'limit': self.limits[ route],
+			'rejected': self._rejected[ route],
+		}) for route in self.limits])
+
+# Concurrency limits of requests
+admission = Admission( {ROUTE_READ: MAX_READS, ROUTE_UPDATE: MAX_UPDATES, ROUTE_CLUSTER: MAX_CLUSTER,
+		ROUTE_WAIT: MAX_WAITS})
+
+
+class RequestBodyError( Exception):
+	"""Raised if request content cannot be accepted."""
+
+	def __init__(self, status, response):
+		Exception.__init__( self, response)
+		self.status = status
+		self.response = response
+
+
+class DeadlineReader:
+	"""Reads of a connection limited by a deadline in total.
+
+	Request line and headers are read through a file object, which calls
+	recv as many times as it needs. Each call is limited by the time left
+	till the deadline, so that a client sending a request slowly does not
+	hold a worker longer than the deadline.
+	"""
+
+	def __init__(self, connection, timeout):
+		self._connection = connection
+		self._timeout = timeout
+		# Absolute time reads are limited by or None
+		self.deadline = None
+
+	def recv(self, size):
+		if self.deadline is None:
+			return self._connection.recv( size)
+		remaining = self.deadline -time.time()
+		if remaining <= 0:
+			raise socket.timeout( 'Request not received in time')
+		self._connection.settimeout( min( remaining, self._timeout))
+		try:
+			return self._connection.recv( size)
+		finally:
+			self._connection.settimeout( self._timeout)
 
 
 def d( path, beginning):
@@ -75,15 +262,181 @@ def e( path, part):
 class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 	""" Interface to the Lighthouse configuration. """
 
-	def __init__(self, *args):
-		BaseHTTPServer.BaseHTTPRequestHandler.__init__( self, *args)
+	# Persistent connections, every response has its Content-Length
+	protocol_version = 'HTTP/1.1'
+	# Buffer the response, it is flushed after each request
+	wbufsize = -1
+	disable_nagle_algorithm = True
+	# Idle persistent connections are closed after timeout
+	timeout = KEEPALIVE_TIMEOUT
+	# Maximal size of request content
+	max_body = MAX_BODY
+	# Limits reads of the request line and headers, see setup
+	_reader = None
+
+	def __init__(self, request, client_address, server, handle=True):
+		"""Sets up the handler of a connection.
+
+		Args:
+			handle: if False, requests are not handled until
+				handle_one_request is called, see ThreadPoolMixIn
+		"""
+		if handle:
+			BaseHTTPServer.BaseHTTPRequestHandler.__init__( self, request, client_address, server)
+			return
+		self.request = request
+		self.client_address = client_address
+		self.server = server
+		self.setup()
+
+	def setup(self):
+		# Nagle's algorithm is a matter of TCP only
+		if self.request.family != socket.AF_INET:
+			self.disable_nagle_algorithm = False
+		BaseHTTPServer.BaseHTTPRequestHandler.setup( self)
+		self._reader = DeadlineReader( self.connection, self.timeout)
+		self.rfile = socket._fileobject( self._reader, 'rb', self.rbufsize)
+
+	def handle_one_request(self):
+		""" Handles one request of a persistent connection. """
+		self.close_connection = 1
+		self._input_read = False
+		self._route = None
+		self._started = None
+		self._status = None
+		self._received = 0
+		self._sent = 0
+		if self._reader is not None:
+			self._reader.deadline = time.time() +HEADER_TIMEOUT
+		try:
+			BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request( self)
+		except RequestBodyError, e:
+			# The rest of the content is not read, give up the connection
+			self.close_connection = 1
+			self._response( e.status, 'text/plain', e.response)
+			self.wfile.flush()
+		finally:
+			if self._route is not None:
+				admission.leave( self._route)
+				self._route = None
+		# Skip the request body if not read, the next request follows it
+		if not self.close_connection and not self._input_read:
+			try:
+				if self._read_input() is None:
+					self.close_connection = 1
+			except RequestBodyError:
+				self.close_connection = 1
+		self._record_request()
+
+	def buffered(self):
+		"""Returns True if the next request has been received already."""
+		buffer = getattr( self.rfile, '_rbuf', None)
+		return buffer is not None and buffer.tell() > 0
+
+	def _record_request(self):
+		"""Records metrics of the request handled."""
+		if self._started is None:
+			return
+		route = 'other'
+		path = urlparse.urlparse( self.path)[2]
+		if path == U_ROOT:
+			route = U_ROOT
+		for known in ROUTES:
+			if d( path, known):
+				route = known
+		method = self.command
+		if method not in METHODS:
+			method = 'other'
+		labels = (route, method, self._status)
+		elapsed = time.time() -self._started
+		metrics.inc( 'lighthouse_requests_total', labels)
+		metrics.observe( 'lighthouse_request_duration_seconds', elapsed, labels)
+		if self._received:
+			metrics.inc( 'lighthouse_received_bytes_total', (route,), self._received)
+		if self._sent:
+			metrics.inc( 'lighthouse_sent_bytes_total', (route,), self._sent)
+		_access_logger.info( 'client=%s method=%s route=%s status=%s ms=%.3f in=%s out=%s path=%s',
+				self._client(), self.command, route, self._status, elapsed *1000,
+				self._received, self._sent, logqueue.Payload( self.path))
+
+	def log_request(self, code='-', size='-'):
+		# Requests are logged once handled, see _record_request
+		pass
+
+	def log_error(self, format, *args):
+		_logger.warning( '%s '+format, self._client(), *args)
+
+	def log_message(self, format, *args):
+		_logger.debug( '%s '+format, self._client(), *args)
+
+	def _client(self):
+		"""Returns address of the client, 'unix' for Unix domain sockets."""
+		if isinstance( self.client_address, tuple):
+			return self.client_address[0]
+		return 'unix'
+
+	def send_response(self, code, message=None):
+		self._status = code
+		BaseHTTPServer.BaseHTTPRequestHandler.send_response( self, code, message)
+
+	def parse_request(self):
+		"""Parses the request and admits it, refused requests are answered."""
+		parsed = BaseHTTPServer.BaseHTTPRequestHandler.parse_request( self)
+		# Headers are read, content has its own deadline
+		if self._reader is not None:
+			self._reader.deadline = None
+		if not parsed:
+			return False
+		self._started = time.time()
+		route = self._route_class()
+		if not self._admit( route):
+			# Do not spend time on content of a shed request
+			if self.headers.getheader( 'Content-Length') or self.headers.getheader( 'Transfer-Encoding'):
+				self.close_connection = 1
+			self._response( 503, 'text/plain', RESPONSE_SERVICE_UNAVAILABLE,
+					[('Retry-After', '%s'%RETRY_AFTER)])
+			self.wfile.flush()
+			return False
+		self._route = route
+		return True
+
+	def _admit(self, route):
+		"""Admits the request of the route class given, see Admission.enter."""
+		return admission.enter( route)
+
+	def _route_class(self):
+		"""Returns the admission route class of the request."""
+		path = urlparse.urlparse( self.path)[2]
+		if d( path, U_COPY) or e( path, U_STATE) or e( path, U_EXCHANGE):
+			return ROUTE_CLUSTER
+		if d( path, U_UPDATE) or d( path, U_LOCK) or e( path, U_TRANSACTION):
+			return ROUTE_UPDATE
+		if d( path, U_DATA) and self.command in ('PUT', 'DELETE'):
+			return ROUTE_UPDATE
+		if d( path, U_DATA) and 'wait' in urlparse.parse_qs( urlparse.urlparse( self.path)[4]):
+			return ROUTE_WAIT
+		return ROUTE_READ
 
 	def _parse_params(self):
-		try:
-			parsed_path = urlparse.urlparse( self.path)
-			self.query_params = dict([p.split('=') for p in parsed_path[4].split('&')])
-		except:
-			self.query_params = {}
+		"""Parses query parameters, the last value of each parameter is kept."""
+		parsed_path = urlparse.urlparse( self.path)
+		params = urlparse.parse_qs( parsed_path[4], keep_blank_values=True)
+		self.query_params = dict( [(name, values[-1]) for name, values in params.iteritems()])
+
+	def _int_param(self, name, default=None):
+		"""Returns query parameter as an integer, raises ValueError if invalid."""
+		if name not in self.query_params:
+			return default
+		return int( self.query_params[ name])
+
+	def _timeout_param(self):
+		"""Returns the timeout query parameter limited to WAIT_TIMEOUT_MAX,
+		raises ValueError if it is not a positive finite number."""
+		timeout = float( self.query_params.get( 'timeout', WAIT_TIMEOUT))
+		# Comparisons with NaN are false
+		if not 0 < timeout < float( 'inf'):
+			raise ValueError( 'Invalid timeout')
+		return min( timeout, WAIT_TIMEOUT_MAX)
 
 	def do_GET(self):
 		""" Processes the GET commands. """
@@ -96,13 +449,20 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 			elif e( path, U_LOCK): self.get_lock()
 			elif d( path, U_COPY): self.get_copy()
 			elif e( path, U_STATE): self.get_state()
+			elif e( path, U_DIFF): self.get_diff()
+			elif e( path, U_METRICS): self.get_metrics()
 			else: self._response_not_found()
 		except data.UnavailableDataError:
 			self._response_service_unavailable()
 
+	def do_HEAD(self):
+		""" Processes the HEAD commands, headers are the same as for GET. """
+		self.do_GET()
+
 	def do_PUT(self):
 		""" Updates internal data with JSON provided. """
 		path, blocks = self._get_path()
+		self._parse_params()
 
 		try:
 			if path == U_ROOT: self._response_forbidden()
@@ -115,9 +475,23 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 		except data.UnavailableDataError:
 			self._response_service_unavailable()
 
+	def do_POST(self):
+		""" Processes the POST commands. """
+		path, blocks = self._get_path()
+		self._parse_params()
+
+		try:
+			if e( path, U_BATCH): self.post_batch()
+			elif e( path, U_TRANSACTION): self.post_transaction()
+			elif e( path, U_EXCHANGE): self.post_exchange()
+			else: self._response_not_found()
+		except data.UnavailableDataError:
+			self._response_service_unavailable()
+
 	def do_DELETE(self):
 		""" Deletes the data given. """
 		path, blocks = self._get_path()
+		self._parse_params()
 
 		try:
 			if path == U_ROOT: self._response_forbidden()
@@ -147,7 +521,7 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 	def put_lock(self, blocks):
 		""" Put lock """
 		code = self._read_input()
-		logging.info("log code: [%s]" % code)
+		_logger.debug( 'Lock code: [%s]', logqueue.Payload( code))
 		if not code:
 			# Missing lock code, try to delete the lock
 
@@ -189,12 +563,64 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 	#
 
 	def get_data(self, blocks):
-		""" Data - return data """
-		subdata = data.get_data( blocks)
-		if subdata is None:
-			self._response_not_found()
+		""" Data - return data
+
+		An older version is returned if its sequence is given as a parameter.
+
+		If a sequence is given as the wait parameter, the request blocks until
+		the data change since that version or until the timeout given in
+		seconds expires. Not modified is returned on timeout.
+
+		Parameters depth, keys_only and fields limit the data returned, see
+		data.project.
+		"""
+		try:
+			sequence = self._int_param( 'sequence')
+			wait = self._int_param( 'wait')
+			timeout = self._timeout_param()
+			projection, tag = self._projection()
+		except ValueError:
+			return self._response_bad_request()
+
+		if wait is not None and not self._wait_data( blocks, wait, timeout):
+			subdata, digest, version = data.get_data_digest( blocks)
+			headers = [('X-Lighthouse-Sequence', version.sequence), ('Vary', 'Accept, Accept-Encoding')]
+			if digest is not None:
+				headers.append( ('ETag', self._etag( digest +tag)))
+			return self._response_not_modified( headers)
+
+		if sequence is None:
+			subdata, digest, version = data.get_data_digest( blocks)
 		else:
-			self._response_json( subdata)
+			subdata, digest, version = data.get_data_at( blocks, sequence)
+		if subdata is None:
+			return self._response_not_found()
+		etag = self._etag( digest +tag)
+		if projection and not self._etag_matches( etag):
+			subdata = data.project( subdata, **projection)
+		self._response_json( subdata, etag=etag,
+				headers=[('X-Lighthouse-Sequence', version.sequence)])
+
+	def _projection(self):
+		"""Returns arguments of data.project given by query parameters and
+		a suffix distinguishing ETags of the projection.
+
+		Raises ValueError if parameters are invalid.
+		"""
+		projection = {}
+		depth = self._int_param( 'depth')
+		if depth is not None:
+			if depth < 0:
+				raise ValueError( 'Negative depth')
+			projection[ 'depth'] = depth
+		if 'keys_only' in self.query_params:
+			projection[ 'keys_only'] = True
+		if 'fields' in self.query_params:
+			projection[ 'fields'] = [x for x in self.query_params[ 'fields'].split( ',') if x]
+		if not projection:
+			return projection, ''
+		spec = repr( sorted( projection.items()))
+		return projection, '-p%08x'%( zlib.crc32( spec) & 0xffffffff)
 
 	def put_data(self, blocks):
 		subdata = data.get_data( blocks)
@@ -284,8 +710,24 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 	#
 
 	def get_copy(self):
-		""" Returns raw data copy. """
-		return self._response_json( data.get_copy())
+		""" Returns raw data copy.
+
+		If the client specifies its version via sequence and checksum
+		parameters, only changes since that version are returned if known.
+		"""
+		if 'sequence' in self.query_params and 'checksum' in self.query_params:
+			try:
+				base = data.DataVersion( self.query_params[ 'sequence'], self.query_params[ 'checksum'])
+			except ValueError:
+				return self._response_bad_request()
+			delta = data.get_delta( base)
+			if delta is not None:
+				return self._response_json( delta)
+
+		copy = data.get_copy()
+		version = copy[ 'version']
+		etag = self._etag( '%s-%s'%(version[ 'sequence'], version[ 'checksum']))
+		return self._response_json( copy, etag=etag)
 
 	def put_copy(self):
 		""" Pushes new data """
@@ -296,9 +738,101 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 		# Update with the content given
 		if data.push_data( content):
 			config.save_configuration()
+			sync.cluster_state.forward()
+		elif isinstance( content, dict) and 'patch' in content and data.is_newer( content):
+			# Patch could not be applied, ask for complete data
+			return self._response_conflict( RESPONSE_UNKNOWN_BASE)
 		self._response_created()
 
 
+	#
+	# Batch /batch
+	#
+
+	def post_batch(self):
+		""" Returns data of many paths at once.
+
+		Paths are sent as a JSON list of strings in the same form as used
+		under /data/, for instance "providers/beta/0". All entries come from
+		the same version of data.
+		"""
+		paths = self._read_input_json()
+		if not isinstance( paths, list) or not all( [isinstance( x, basestring) for x in paths]):
+			return self._response_bad_request()
+
+		entries, version = data.get_batch( [self._split_path( x) for x in paths])
+
+		response = {}
+		response[ 'version'] = version.to_dict()
+		response[ 'data'] = {}
+		response[ 'missing'] = []
+		for path, entry in zip( paths, entries):
+			if entry is None:
+				response[ 'missing'].append( path)
+			else:
+				response[ 'data'][ path] = entry
+		return self._response_json( response)
+
+	#
+	# Transaction /transaction
+	#
+
+	def post_transaction(self):
+		""" Applies many changes atomically in one request.
+
+		The content is a JSON dictionary with 'ops', a list of operations,
+		and optional 'base' version the operations expect. Each operation is
+		a dictionary with 'op' (set or delete), 'path' in the same form as
+		under /data/, and 'value' for set.
+		"""
+		content = self._read_input_json()
+		try:
+			ops = []
+			for op in content[ 'ops']:
+				if op[ 'op'] == 'set':
+					ops.append( {'op': 'replace', 'path': self._split_path( op[ 'path']), 'value': op[ 'value']})
+				elif op[ 'op'] == 'delete':
+					ops.append( {'op': 'remove', 'path': self._split_path( op[ 'path'])})
+				else:
+					return self._response_bad_request()
+			base = None
+			if content.get( 'base') is not None:
+				base = data.DataVersion.from_dict( content[ 'base'])
+		except (TypeError, KeyError, ValueError, AttributeError):
+			return self._response_bad_request()
+
+		result, version = data.transaction( ops, base)
+		if result == data.TRX_OK:
+			# Let other instances know
+			sync.cluster_state.force_push()
+			# Save new configuration
+			config.save_configuration()
+			return self._response_json( {'version': version.to_dict()})
+		elif result == data.TRX_LOCKED:
+			return self._response_forbidden( RESPONSE_LOCKED)
+		elif result == data.TRX_CONFLICT:
+			return self._response_conflict( RESPONSE_CONCURRENT)
+		return self._response_not_found()
+
+	#
+	# Differences /diff
+	#
+
+	def get_diff(self):
+		""" Returns changes between two versions kept in memory. """
+		try:
+			from_sequence = self._int_param( 'from')
+			to_sequence = self._int_param( 'to')
+		except ValueError:
+			return self._response_bad_request()
+		if from_sequence is None:
+			return self._response_bad_request()
+
+		response = data.get_diff( from_sequence, to_sequence)
+		if response is None:
+			return self._response_not_found( RESPONSE_UNKNOWN_VERSION)
+		return self._response_json( response)
+
 	#
 	# State /state/
 	#
@@ -308,8 +842,24 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 		response = data.get_copy( get_data=False)
 		response[ 'cluster'] = sync.cluster_state.get_state()
 		response[ 'Me'] = sync.cluster_state.me
+		response[ 'index'] = data.cur_data().index_stats()
+		admitted = admission.get_state()
+		admitted[ 'queue'] = getattr( self.server, 'queue_depth', lambda: 0)()
+		admitted[ 'idle'] = getattr( self.server, 'idle_connections', lambda: 0)()
+		admitted[ 'queue-refused'] = getattr( self.server, 'refused_requests', lambda: 0)()
+		response[ 'admission'] = admitted
+		response[ 'connections'] = helpers.pool.get_state()
 		return self._response_json( response)
 
+	#
+	# Metrics /metrics
+	#
+
+	def get_metrics(self):
+		""" Returns metrics in Prometheus text format. """
+		metrics.set_gauge( 'lighthouse_sequence', data.cur_data().version.sequence)
+		return self._response( 200, metrics.CONTENT_TYPE, metrics.render())
+
 	def put_state(self):
 		""" Accepts cluster state from a different instance. """
 		# Get content
@@ -321,6 +871,33 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 			self._response_bad_request()
 
 
+	def post_exchange(self):
+		""" Exchanges state with a different instance by one request.
+
+		The instance sends its version and cluster state, the response
+		contains ours. If the instance is behind, the response contains
+		changes since its version or complete data under 'copy' as well,
+		in the same form as /copy.
+		"""
+		content = self._read_input_json()
+		try:
+			cluster = content[ 'cluster']
+			version = data.DataVersion.from_dict( content[ 'version'])
+			sync.cluster_state.update_state( cluster)
+		except (TypeError, KeyError, ValueError, AttributeError):
+			return self._response_bad_request()
+
+		response = data.get_copy( get_data=False)
+		if version < data.DataVersion.from_dict( response[ 'version']):
+			copy = data.get_delta( version)
+			if copy is None:
+				copy = data.get_copy()
+			response[ 'version'] = copy[ 'version']
+			response[ 'copy'] = copy
+		response[ 'cluster'] = sync.cluster_state.get_members()
+		return self._response_json( response)
+
+
 	#
 	# Root request
 	#
@@ -343,13 +920,17 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 	#
 
 	def _response(self, status, content_type, text, headers=[]):
+		"""Sends the response. Text is None if not known for HEAD."""
 		self.send_response( status)
 		self.send_header( 'Content-Type', content_type)
-		self.send_header( 'Content-Length', '%s'%len( text))
+		if text is not None:
+			self.send_header( 'Content-Length', '%s'%len( text))
 		for header in headers:
 			self.send_header( header[0], header[1])
 		self.end_headers()
-		self.wfile.write( text)
+		if text is not None and self.command != 'HEAD':
+			self.wfile.write( text)
+			self._sent += len( text)
 		return status
 
 	def _response_forbidden( self, response = RESPONSE_FORBIDDEN):
@@ -361,9 +942,50 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 	def _response_plain( self, response):
 		return self._response( 200, 'text/plain', response)
 
-	def _response_json( self, response):
-		return self._response( 200, 'application/json',
-				helpers.dump_json( response))
+	def _response_json( self, response, etag=None, headers=[]):
+		"""Sends the response as JSON.
+
+		If the etag given matches the client's one, the response is not
+		serialized and 304 (not modified) is sent instead. The etag must
+		be made by _etag for the representation negotiated.
+		"""
+		headers = list( headers)
+		headers.append( ('Vary', 'Accept, Accept-Encoding'))
+		if etag is not None:
+			headers.append( ('ETag', etag))
+			if self._etag_matches( etag):
+				return self._response_not_modified( headers)
+		content_type, encoding = self._representation()
+		# Serialization is not needed to answer HEAD
+		if self.command == 'HEAD':
+			return self._response( 200, content_type, None, headers)
+
+		# Serialize and compress, versioned content only once
+		pretty = 'pretty' in self.query_params
+		key = (etag, content_type, pretty, encoding)
+		body = None
+		if etag is not None:
+			body = _bodies.get( key)
+		if body is None:
+			with metrics.Timer( 'lighthouse_serialization_duration_seconds'):
+				text = helpers.encode( response, content_type, pretty)
+				if encoding is not None and len( text) >= helpers.COMPRESS_MIN:
+					body = (helpers.compress( text, encoding), encoding)
+				else:
+					body = (text, None)
+			if etag is not None:
+				_bodies.put( key, body)
+
+		if body[1] is not None:
+			headers.append( ('Content-Encoding', body[1]))
+		return self._response( 200, content_type, body[0], headers)
+
+	def _response_not_modified( self, headers):
+		self.send_response( 304)
+		for header in headers:
+			self.send_header( header[0], header[1])
+		self.end_headers()
+		return 304
 
 	def _response_created( self, response = RESPONSE_CREATED):
 		return self._response( 201, 'application/json', response)
@@ -380,6 +1002,48 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 	def _response_service_unavailable( self, response = RESPONSE_SERVICE_UNAVAILABLE):
 		return self._response( 503, 'text/plain', response)
 
+	def _accepted_encoding(self):
+		"""Returns the preferred content encoding accepted by the client or
+		None."""
+		return helpers.negotiate_encoding( self.headers.getheader( 'Accept-Encoding'))
+
+	def _representation(self):
+		"""Returns content type and encoding of the response negotiated
+		with the client."""
+		return helpers.negotiate_type( self.headers.getheader( 'Accept')), self._accepted_encoding()
+
+	def _etag(self, value):
+		"""Returns a strong ETag of the value given for the representation
+		negotiated, bodies of other types and encodings have other tags."""
+		content_type, encoding = self._representation()
+		if content_type == helpers.TYPE_MSGPACK:
+			value += '-msgpack'
+		if encoding is not None:
+			value += '-' +encoding
+		return '"%s"'%value
+
+	def _etag_matches(self, etag):
+		"""Checks If-None-Match header of the request against the etag given."""
+		none_match = self.headers.getheader( 'If-None-Match')
+		if not none_match:
+			return False
+		for tag in none_match.split( ','):
+			tag = tag.strip()
+			if tag.startswith( 'W/'):
+				tag = tag[2:]
+			if tag == etag or tag == '*':
+				return True
+		return False
+
+	def _wait_data(self, blocks, sequence, timeout):
+		"""Waits until data change since the version given, see
+		data.wait_data."""
+		return data.wait_data( blocks, sequence, timeout)
+
+	def _split_path(self, path):
+		"""Splits path given as a string into its elements."""
+		return [x for x in path.split( '/') if x != '']
+
 	def _get_path(self):
 		url = urlparse.urlparse( self.path)
 		components = url.path.split('?',1)[0].split( '/')[1:]
@@ -388,17 +1052,135 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 		return url.path, components
 
 	def _read_input(self):
+		"""Reads the request content.
+
+		The content is read and decompressed by blocks, so that too large or
+		too slow content is refused before it is read completely. Accepted
+		content is returned whole, it is not parsed incrementally: decoders
+		of JSON and msgpack take complete content. Blocks are released once
+		joined, a single block is returned as it is, so parsing content
+		takes at most twice its size while joined and the object decoded.
+
+		Returns:
+			Content, '' if there is none, or None if it cannot be read
+		Raises:
+			RequestBodyError if the content is too large or too slow
+		"""
+		self._input_read = True
+		deadline = time.time() +BODY_TIMEOUT
+		chunks = []
+		size = 0
 		try:
-			size_raw = self.headers.getheader('Content-Length')
-			if size_raw == None:
-				return ''
-			size = int( size_raw)
-			if size < 1:
-				return ''
-			read = self.rfile.read( size)
-		except IOError:
+			encoding = self.headers.getheader( 'Content-Encoding')
+			decompressor = None
+			if encoding:
+				decompressor = helpers.decompressor( encoding)
+			for chunk in self._read_chunks( deadline):
+				self._received += len( chunk)
+				if time.time() > deadline:
+					raise RequestBodyError( 408, RESPONSE_TIMEOUT)
+				if decompressor is not None:
+					chunk = decompressor.decompress( chunk, self.max_body -size +1)
+					if decompressor.unconsumed_tail:
+						raise RequestBodyError( 413, RESPONSE_TOO_LARGE)
+				size += len( chunk)
+				if size > self.max_body:
+					raise RequestBodyError( 413, RESPONSE_TOO_LARGE)
+				if chunk:
+					chunks.append( chunk)
+			if decompressor is not None:
+				chunk = decompressor.flush()
+				size += len( chunk)
+				if size > self.max_body:
+					raise RequestBodyError( 413, RESPONSE_TOO_LARGE)
+				if chunk:
+					chunks.append( chunk)
+		except socket.timeout:
+			raise RequestBodyError( 408, RESPONSE_TIMEOUT)
+		except (IOError, ValueError, zlib.error):
 			return None
-		return read
+		if not chunks:
+			return ''
+		if len( chunks) == 1:
+			return chunks[0]
+		content = ''.join( chunks)
+		del chunks[:]
+		return content
+
+	def _read_chunks(self, deadline):
+		"""Reads the raw request content by blocks until the deadline given.
+
+		Both Content-Length and chunked transfer encoding are supported.
+		Raises ValueError if the content is malformed.
+		"""
+		if self.headers.getheader( 'Transfer-Encoding', '').lower() == 'chunked':
+			total = 0
+			while True:
+				line = self._read_line( deadline)
+				size = int( line.split( ';', 1)[0].strip(), 16)
+				if size == 0:
+					break
+				total += size
+				if total > self.max_body:
+					raise RequestBodyError( 413, RESPONSE_TOO_LARGE)
+				while size > 0:
+					chunk = self._read_some( min( size, READ_CHUNK), deadline)
+					if not chunk:
+						raise ValueError( 'Incomplete content')
+					size -= len( chunk)
+					yield chunk
+				self._read_line( deadline)
+			# Skip trailers
+			while self._read_line( deadline).strip():
+				pass
+			return
+
+		size_raw = self.headers.getheader( 'Content-Length')
+		if size_raw is None:
+			return
+		size = int( size_raw)
+		if size > self.max_body:
+			raise RequestBodyError( 413, RESPONSE_TOO_LARGE)
+		while size > 0:
+			chunk = self._read_some( min( size, READ_CHUNK), deadline)
+			if not chunk:
+				raise ValueError( 'Incomplete content')
+			size -= len( chunk)
+			yield chunk
+
+	def _read_some(self, size, deadline):
+		"""Reads at most size bytes of content, whatever arrives first.
+
+		Content buffered already is returned at once. A read from the socket
+		is limited by the deadline given, so that content trickling slowly
+		is not waited for.
+		Raises socket.timeout after the deadline.
+		"""
+		buffer = getattr( self.rfile, '_rbuf', None)
+		connection = getattr( self, 'connection', None)
+		if buffer is None or connection is None:
+			# Content read in memory
+			return self.rfile.read( size)
+		if buffer.tell() > 0:
+			return self.rfile.read( min( size, buffer.tell()))
+		remaining = deadline -time.time()
+		if remaining <= 0:
+			raise socket.timeout( 'Content not received in time')
+		connection.settimeout( remaining)
+		try:
+			return connection.recv( size)
+		finally:
+			connection.settimeout( self.timeout)
+
+	def _read_line(self, deadline):
+		"""Reads a line of chunked content framing until the deadline given."""
+		line = []
+		while len( line) < READ_CHUNK:
+			c = self._read_some( 1, deadline)
+			line.append( c)
+			if c in ('\n', ''):
+				break
+		return ''.join( line)
 
 	def _read_input_post(self):
 		sent = self._read_input()
@@ -407,39 +1189,315 @@ class LighthouseRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler):
 		try:
 			post = urlparse.parse_qs( sent, keep_blank_values=True,
 						strict_parsing=True)
-			self.log_message( 'POST: %s', post)
+			_logger.debug( 'POST: %s', logqueue.Payload( post))
 			return post
 		except ValueError:
 			return None
 
 
 	def _read_input_json(self):
+		"""Reads and decodes the content, JSON or other type given by
+		Content-Type."""
 		try:
 			sent = self._read_input()
-			if sent is not None:
-				content = json.loads( sent)
+			if sent is None:
+				return None
+			content = helpers.decode( sent, self.headers.gettype())
 		except ValueError:
-			self.log_message( 'JSON: /invalid, sent=[%s]' % sent)
+			_logger.debug( 'JSON: invalid, sent=[%s]', logqueue.Payload( sent))
 			return None
-			
-		self.log_message( 'JSON: %s', content)
+
+		_logger.debug( 'JSON: %s', logqueue.Payload( content))
 		return content
 
 
 
 
-class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+class Poller:
+	"""Watches new and idle persistent connections by a single thread.
+
+	A connection with a request arriving is handed to workers, connections
+	idle for too long are closed. If the queue of workers is full, the
+	request is refused with 503 instead of waiting, so that the thread keeps
+	watching other connections.
+	"""
+
+	def __init__(self, requests):
+		"""Starts the thread, ready connections are put to the queue of
+		workers given."""
+		inlock.add_lock( self)
+		self._requests = requests
+		# File descriptor -> (server, request, client address, handler, deadline)
+		self._idle = {}
+		# Connections to watch, added by the thread
+		self._added = []
+		self._poll = select.poll()
+		self._wakeup, self._wakeup_write = os.pipe()
+		self._poll.register( self._wakeup, select.POLLIN)
+		# Number of requests refused since the queue was full
+		self.refused = 0
+		thread = threading.Thread( target=self._run, name='Poller')
+		thread.setDaemon( True)
+		thread.start()
+
+	def add(self, server, request, client_address, handler=None):
+		"""Watches the connection given, the handler is None for a new
+		connection."""
+		deadline = time.time() +server.RequestHandlerClass.timeout
+		self._add( (server, request, client_address, handler, deadline))
+		try:
+			os.write( self._wakeup_write, 'x')
+		except OSError:
+			pass
+
+	@inlock.synchronized
+	def _add(self, connection):
+		self._added.append( connection)
+
+	@inlock.synchronized
+	def _take_added(self):
+		added = self._added
+		self._added = []
+		return added
+
+	def __len__(self):
+		return len( self._idle)
+
+	def _run(self):
+		while True:
+			try:
+				self._poll_once()
+			except Exception:
+				_logger.exception( 'Poller failed')
+
+	def _poll_once(self):
+		"""Watches connections added, hands over those with a request and
+		closes those idle for too long."""
+		for connection in self._take_added():
+			try:
+				fd = connection[1].fileno()
+				self._poll.register( fd, select.POLLIN)
+				self._idle[ fd] = connection
+			except Exception:
+				_logger.exception( 'Cannot watch connection')
+				self._close( connection)
+		try:
+			events = self._poll.poll( 1000)
+		except select.error:
+			return
+		for fd, _ in events:
+			if fd == self._wakeup:
+				os.read( self._wakeup, 4096)
+				continue
+			connection = self._unwatch( fd)
+			if connection is None:
+				continue
+			try:
+				self._requests.put_nowait( connection[ :4])
+			except Queue.Full:
+				self.refused += 1
+				self._refuse( connection)
+		now = time.time()
+		for fd, connection in self._idle.items():
+			if connection[4] <= now:
+				self._unwatch( fd)
+				self._close( connection)
+
+	def _unwatch(self, fd):
+		"""Stops watching the connection given by its descriptor, returns
+		the connection or None if not watched."""
+		try:
+			self._poll.unregister( fd)
+		except (KeyError, ValueError):
+			pass
+		return self._idle.pop( fd, None)
+
+	def _refuse(self, connection):
+		"""Answers the request arriving with 503 and closes the connection."""
+		request = connection[1]
+		try:
+			# The response fits in the socket buffer, do not wait for the client
+			request.setblocking( 0)
+			request.send( RESPONSE_QUEUE_FULL%RETRY_AFTER)
+			# Unread data would reset the connection before the response
+			request.recv( READ_CHUNK)
+		except socket.error:
+			pass
+		self._close( connection)
+
+	def _close(self, connection):
+		"""Closes the connection given, errors are logged only."""
+		server, request, _, handler, _ = connection
+		try:
+			if handler is None:
+				server.shutdown_request( request)
+			else:
+				server.shutdown_connection( handler)
+		except Exception:
+			_logger.exception( 'Cannot close connection')
+
+
+class ThreadPoolMixIn:
+	"""Handles requests by a fixed number of worker threads.
+
+	Workers handle requests, not connections: a connection is watched by
+	a poller until a request arrives and between requests, so idle
+	connections do not take a worker. Connections with a request wait for
+	a worker in a bounded queue, requests over its size are refused.
+	"""
+
+	workers = WORKERS
+	queue_size = QUEUE_SIZE
+
+	def start_workers(self):
+		self._requests = Queue.Queue( self.queue_size)
+		self._poller = Poller( self._requests)
+		for i in xrange( self.workers):
+			worker = threading.Thread( target=self._work, name='Worker %s'%i)
+			worker.setDaemon( True)
+			worker.start()
+
+	def share_workers(self, other):
+		"""Hands connections to workers of the other server given."""
+		self._requests = other._requests
+		self._poller = other._poller
+
+	def _work(self):
+		while True:
+			server, request, client_address, handler = self._requests.get()
+			try:
+				if handler is None:
+					handler = server.RequestHandlerClass( request, client_address, server, handle=False)
+				handler.handle_one_request()
+				# Pipelined requests are not seen by the poller
+				while not handler.close_connection and handler.buffered():
+					handler.handle_one_request()
+				keep = not handler.close_connection
+			except socket.error:
+				# Connection reset by the client
+				keep = False
+			except:
+				server.handle_error( request, client_address)
+				keep = False
+			if keep:
+				self._poller.add( server, request, client_address, handler)
+			elif handler is None:
+				server.shutdown_request( request)
+			else:
+				server.shutdown_connection( handler)
+
+	def shutdown_connection(self, handler):
+		"""Closes the connection of the handler given."""
+		try:
+			handler.finish()
+		except socket.error:
+			pass
+		self.shutdown_request( handler.request)
+
+	def process_request(self, request, client_address):
+		self._poller.add( self, request, client_address)
+
+	def queue_depth(self):
+		"""Returns number of connections waiting for a worker."""
+		return self._requests.qsize()
+
+	def idle_connections(self):
+		"""Returns number of connections waiting for a request."""
+		return len( self._poller)
+
+	def refused_requests(self):
+		"""Returns number of requests refused since the queue was full."""
+		return self._poller.refused
+
+
+class ThreadedHTTPServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
 	""" Handles requests in separate threads to avoid blocks. """
 
+	request_queue_size = QUEUE_SIZE
+
+
+class UnixHTTPServer(ThreadPoolMixIn, SocketServer.UnixStreamServer):
+	""" Handles requests of a Unix domain socket. """
+
+	request_queue_size = QUEUE_SIZE
+	mode = UNIX_SOCKET_MODE
 
-def run( bind_address):
+	def server_bind(self):
+		bind_unix( self.socket, self.server_address, self.mode)
+
+
+def bind_unix( sock, path, mode):
+	"""Binds the socket given to a Unix domain socket path.
+
+	The socket file gets the permissions given. A file left by a previous
+	instance is replaced, a socket which is still served is not.
+
+	Raises socket.error if the path cannot be bound.
+	"""
+	if os.path.exists( path) and stat.S_ISSOCK( os.stat( path).st_mode):
+		probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect( path)
+		except socket.error:
+			os.unlink( path)
+		else:
+			raise socket.error( errno.EADDRINUSE, 'Socket %s is in use'%path)
+		finally:
+			probe.close()
+	umask = os.umask( 0777 & ~mode)
+	try:
+		sock.bind( path)
+	finally:
+		os.umask( umask)
+
+
+def run( bind_address, workers=WORKERS, queue_size=QUEUE_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT,
+		max_body=MAX_BODY, limits={}, unix_socket=None, unix_socket_mode=UNIX_SOCKET_MODE):
+	"""Runs the server.
+
+	Connections of both the TCP and the Unix domain socket are handled by
+	the same workers.
+
+	Args:
+		bind_address: (host, port) tuple to listen on or None
+		workers: number of worker threads
+		queue_size: maximal number of connections waiting for a worker
+		keepalive_timeout: time after an idle connection is closed in seconds
+		max_body: maximal size of request content in bytes
+		limits: maximal numbers of concurrent requests by route class
+		unix_socket: path of a Unix domain socket to listen on or None
+		unix_socket_mode: permissions of the Unix domain socket
+	"""
 	LighthouseRequestHandler.server_version = SERVER_NAME +'/' +__version__
+	LighthouseRequestHandler.timeout = keepalive_timeout
+	LighthouseRequestHandler.max_body = max_body
+	admission.limits.update( limits)
+	admission.limits[ ROUTE_WAIT] = min( admission.limits[ ROUTE_WAIT], max( 1, workers /2))
+	for server_class in (ThreadedHTTPServer, UnixHTTPServer):
+		server_class.workers = workers
+		server_class.queue_size = queue_size
+		server_class.request_queue_size = queue_size
+	UnixHTTPServer.mode = unix_socket_mode
+	servers = []
 	try:
-		httpd = ThreadedHTTPServer( bind_address, LighthouseRequestHandler)
-	except socket.error, e:
-		_logger.critical( 'Cannot start server %s:%s: %s', bind_address[0], bind_address[1], e)
+		if bind_address is not None:
+			servers.append( ThreadedHTTPServer( bind_address, LighthouseRequestHandler))
+		if unix_socket is not None:
+			servers.append( UnixHTTPServer( unix_socket, LighthouseRequestHandler))
+	except (socket.error, OSError), e:
+		_logger.critical( 'Cannot start server: %s', e)
 		return
-	_logger.info( 'Starting server on %s:%s', bind_address[0], bind_address[1])
+	if bind_address is not None:
+		_logger.info( 'Starting server on %s:%s', bind_address[0], bind_address[1])
+	if unix_socket is not None:
+		_logger.info( 'Starting server on %s', unix_socket)
+	httpd = servers[0]
+	httpd.start_workers()
+	for other in servers[1:]:
+		other.share_workers( httpd)
+		listener = threading.Thread( target=other.serve_forever, name='Listener %s'%unix_socket)
+		listener.setDaemon( True)
+		listener.start()
 	try:
 		httpd.serve_forever()
 	except KeyboardInterrupt:
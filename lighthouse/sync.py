@@ -1,11 +1,21 @@
 
 # System imports
 import logging
+import random
+import time
 
 # Local imports
 import inlock
 import monitor
 import helpers
+import data
+import metrics
+
+# Number of instances contacted by a gossip round, 0 to monitor all
+# instances continuously
+GOSSIP_FANOUT = 0
+# Period of gossip rounds in seconds
+GOSSIP_PERIOD = 0.5
 
 
 logger = logging.getLogger(__name__)
@@ -16,27 +26,40 @@ class ClusterState:
 	"""
 
 
-	def __init__(self, me):
+	def __init__(self, me, fanout=GOSSIP_FANOUT, period=GOSSIP_PERIOD):
 		"""Initializes the cluster state with all entries empty.
 
 		Args:
-			me: My address in the form of IP:port
+			me: My address in the form of IP:port or None if the instance
+				serves a Unix domain socket only and is not a member of
+				any cluster
+			fanout: number of instances contacted by a gossip round, 0 to
+				monitor all instances continuously
+			period: period of gossip rounds in seconds
 		"""
 		# Store my address
 		self.me = me
 		# All instance monitors
 		self.instance_monitors = []
+		self.fanout = fanout
+		# Version being spread and time it became current
+		self._spreading = None
 		inlock.add_lock( self)
+		if fanout:
+			monitor.scheduler.add( GossipRound( self, period))
 
 	@inlock.synchronized
 	def add_instance( self, addr):
 		"""Adds a new instance to the cluster.
 
-		New asynchronous monitor is created.
+		New monitor is created and scheduled.
 
 		Args:
 			addr: address in the form of ip:port or host:port
 		"""
+		# A local instance does not monitor any instances
+		if self.me is None:
+			return
 		# Check that we are not trying to add ourselves
 		if addr == self.me:
 			return
@@ -45,9 +68,9 @@ class ClusterState:
 			return
 
 		# Create a new state for the instance
-		# Instantiate and start a monitor
-		mon = monitor.Monitor( addr)
-		mon.start()
+		# Instantiate and schedule a monitor
+		mon = monitor.Monitor( addr, gossip=bool( self.fanout))
+		monitor.scheduler.add( mon)
 		self.instance_monitors.append( mon)
 
 	@inlock.synchronized
@@ -56,12 +79,70 @@ class ClusterState:
 		"""
 		return [x.to_dict() for x in self.instance_monitors]
 
+	def get_members(self):
+		"""Returns state of the cluster with our address as told to other
+		instances.
+		"""
+		members = self.get_state()
+		if self.me is not None:
+			members.append( {'address': self.me})
+		return members
+
 	@inlock.synchronized
 	def force_push(self):
-		"""Force all monitors to send update.
+		"""Force all monitors to send update, randomly chosen ones in
+		gossip mode.
+		"""
+		self._spread( data.cur_data().version)
+		for mon in self._targets():
+			mon.force_push()
+
+	@inlock.synchronized
+	def forward(self):
+		"""Spreads data received from another instance.
+
+		In gossip mode they are pushed further to randomly chosen instances,
+		other instances are updated by the sender otherwise.
 		"""
-		for monitor in self.instance_monitors:
-			monitor.force_push.set()
+		if self.fanout:
+			self.force_push()
+		else:
+			self._spread( data.cur_data().version)
+
+	@inlock.synchronized
+	def gossip(self):
+		"""Exchanges versions with randomly chosen instances."""
+		for mon in self._targets():
+			mon.exchange()
+
+	def _targets(self):
+		"""Returns monitors to contact, all or fanout of them."""
+		if not self.fanout or self.fanout >= len( self.instance_monitors):
+			return list( self.instance_monitors)
+		return random.sample( self.instance_monitors, self.fanout)
+
+	def _spread(self, version):
+		"""Starts measuring convergence of the version given."""
+		if self._spreading is None or self._spreading[0] < version:
+			self._spreading = (version, time.time())
+		self.check_converged()
+
+	@inlock.synchronized
+	def check_converged(self):
+		"""Records convergence time once all reachable instances are known
+		to have the version being spread."""
+		if self._spreading is None:
+			return
+		version, started = self._spreading
+		reachable = False
+		for mon in self.instance_monitors:
+			known, is_reachable = mon.known_version()
+			if is_reachable and known < version:
+				return
+			reachable = reachable or is_reachable
+		if reachable:
+			metrics.observe( 'lighthouse_convergence_seconds', time.time() -started)
+			self._spreading = None
 
 	def update_state(self, cstate):
 		"""Accepts all new instances in the state given.
@@ -77,11 +158,29 @@ class ClusterState:
 			return False
 		return True
 
+
+class GossipRound:
+	"""Runs gossip rounds of the cluster given by the monitor scheduler."""
+
+	def __init__(self, cluster, period):
+		self.cluster = cluster
+		self.period = period
+		# Time of the next round and if a round runs, managed by Scheduler
+		self._due = None
+		self._running = False
+
+	def cycle(self):
+		self.cluster.gossip()
+
+	def next_cycle(self):
+		return time.time() +self.period
+
+
 # State of the whole cluster
 cluster_state = None
 
-def init_cluster_state( me):
+def init_cluster_state( me, fanout=GOSSIP_FANOUT, period=GOSSIP_PERIOD):
 	"""Initializes the whole cluster state. """
 	global cluster_state
-	cluster_state = ClusterState( me)
+	cluster_state = ClusterState( me, fanout, period)
 
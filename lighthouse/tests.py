@@ -2,9 +2,29 @@
 
 # System imports
 import unittest
+import BaseHTTPServer
+import SocketServer
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+import logging
+import mimetools
+import httplib
+import asyncore
+import StringIO
 
 # Local imports
 import data
+import eventloop
+import helpers
+import logqueue
+import metrics
+import monitor
+import server
+import sync
 
 class TestData(unittest.TestCase):
 
@@ -31,4 +51,984 @@ class TestData(unittest.TestCase):
 		# TODO
 		pass
 
+	def test_checksum(self):
+		d = data.Data( {'a': 1, 'b': {'c': [1, 2, 3]}})
+		checksum = d.get_checksum()
+		self.assertEquals( checksum, data.Data( {'b': {'c': [1, 2, 3]}, 'a': 1}).get_checksum())
+		self.assertNotEquals( checksum, data.Data( {'a': 1, 'b': {'c': [1, 2]}}).get_checksum())
+		self.assertNotEquals( checksum, data.Data( {'a': '1', 'b': {'c': [1, 2, 3]}}).get_checksum())
+
+		# Incremental updates must match the checksum of a fresh tree
+		self.assertTrue( d.set( ['b', 'd'], {'e': 'f'}))
+		self.assertEquals( d.get_checksum(), data.Data( d.data).get_checksum())
+		self.assertTrue( d.delete( ['b', 'c', '0']))
+		self.assertEquals( d.get_checksum(), data.Data( d.data).get_checksum())
+		self.assertTrue( d.delete( ['b', 'd']))
+		self.assertTrue( d.set( ['b', 'c'], [1, 2, 3]))
+		self.assertEquals( checksum, d.get_checksum())
+
+	def test_sharing(self):
+		orig = {'a': {'x': [1, 2]}, 'b': {'y': 'z'}}
+		d = data.Data( orig)
+		u = data.Data.copy( d)
+		self.assertTrue( u.set( ['a', 'w'], 3))
+		self.assertTrue( u.delete( ['b', 'y']))
+		# Original version is untouched
+		self.assertEquals( {'a': {'x': [1, 2]}, 'b': {'y': 'z'}}, d.data)
+		self.assertEquals( {'a': {'x': [1, 2], 'w': 3}, 'b': {}}, u.data)
+		# Untouched subtrees are shared
+		self.assertIs( d.data['a']['x'], u.data['a']['x'])
+		self.assertIsNot( d.data['a'], u.data['a'])
+
 	
+
+	def test_diff(self):
+		old = data.Data( {'a': {'x': [1, 2], 'y': {}}, 'b': 'c', 'd': [1]})
+		new = data.Data.copy( old)
+		self.assertTrue( new.set( ['a', 'x', '1'], 3))
+		self.assertTrue( new.set( ['a', 'y', 'z'], 'w'))
+		self.assertTrue( new.delete( ['b']))
+		self.assertTrue( new.delete( ['d', '0']))
+		ops = data.diff( old, new)
+		self.assertEquals( 4, len( ops))
+
+		# Patch transforms the old version to the new one
+		patched = data.Data.copy( old)
+		self.assertTrue( patched.patch( ops))
+		self.assertEquals( new.data, patched.data)
+		self.assertEquals( new.get_checksum(), patched.get_checksum())
+		self.assertEquals( [], data.diff( new, patched))
+
+	def test_push_patch(self):
+		base = data.cur_data()
+		new = data.Data.copy( base)
+		self.assertTrue( new.set( ['patched'], 1))
+		copy = {
+			'version': {'sequence': base.version.sequence +1, 'checksum': new.get_checksum()},
+			'base': base.version.to_dict(),
+			'patch': data.diff( base, new),
+		}
+		# Patch producing different data is refused
+		wrong = dict( copy, version={'sequence': base.version.sequence +1, 'checksum': 'x'})
+		self.assertFalse( data.push_data( wrong))
+		self.assertTrue( data.push_data( copy))
+		self.assertEquals( 1, data.get_data( ['patched']))
+		# Delta since the base version is known
+		self.assertEquals( copy[ 'patch'], data.get_delta( base.version)[ 'patch'])
+		self.assertIsNone( data.get_delta( data.DataVersion( 0, 'x')))
+
+	def test_history(self):
+		for i in range( 5):
+			self.assertTrue( data.try_acquire_lock( 'history'))
+			self.assertTrue( data.update_entry_root( ['history'], i))
+			self.assertEquals( data.LCK_OK, data.release_lock())
+		current = data.cur_data().version.sequence
+
+		# Older versions are available
+		self.assertEquals( 3, data.get_data_at( ['history'], current -1)[0])
+		response = data.get_diff( current -2)
+		self.assertEquals( [{'op': 'replace', 'path': ['history'], 'value': 4}], response[ 'patch'])
+
+		# Only the limited number of versions is kept
+		data.set_history_limits( size=2)
+		self.assertEquals( 2, len( data.get_history()))
+		self.assertIsNone( data.get_diff( current -2))
+		self.assertEquals( (None, None, None), data.get_data_at( ['history'], current -2))
+		data.set_history_limits( size_bytes=0)
+		self.assertEquals( [data.cur_data().version], data.get_history())
+		data.set_history_limits()
+
+	def test_history_bytes(self):
+		def commit( path, value):
+			self.assertTrue( data.try_acquire_lock( 'bytes'))
+			self.assertTrue( data.update_entry_root( path, value))
+			self.assertEquals( data.LCK_OK, data.release_lock())
+		big = dict( ('k%d'%i, 'x'*100) for i in range( 1000))
+		commit( ['bytes'], big)
+
+		# Replaced subtree is accounted in full even if it looks the same
+		before = data._history_bytes
+		commit( ['bytes'], dict( big, k0='y'))
+		self.assertTrue( data._history_bytes -before > 1000 *100)
+		# Shared subtrees are not accounted, only nodes on the path
+		before = data._history_bytes
+		commit( ['bytes', 'k1'], 'y')
+		self.assertTrue( data._history_bytes -before < 1000 *10)
+
+	def test_wait(self):
+		self.assertTrue( data.try_acquire_lock( 'wait'))
+		self.assertTrue( data.update_entry_root( ['wait'], {'a': 1, 'b': 1}))
+		self.assertEquals( data.LCK_OK, data.release_lock())
+		current = data.cur_data().version.sequence
+
+		self.assertFalse( data.wait_data( ['wait'], current, 0.01))
+		self.assertTrue( data.try_acquire_lock( 'wait'))
+		self.assertTrue( data.update_entry_root( ['wait', 'a'], 2))
+		self.assertEquals( data.LCK_OK, data.release_lock())
+		# Only the changed subsection is reported
+		self.assertTrue( data.wait_data( ['wait', 'a'], current, 0.01))
+		self.assertFalse( data.changed_since( ['wait', 'b'], current))
+		self.assertTrue( data.changed_since( ['wait'], current))
+
+	def test_index(self):
+		d = data.Data( {'a': {'b': [1, {'c': 'x'}]}})
+		self.assertEquals( 'x', d.get( ['a', 'b', '1', 'c']))
+		self.assertEquals( 'x', d.get( ['a', 'b', '1', 'c']))
+		self.assertIsNone( d.get( ['a', 'b', '2']))
+		self.assertEquals( 1, d.index_stats()[ 'entries'])
+		self.assertEquals( d.hashes[1]['a'][0], d.get_digest( ['a']))
+
+		# Changes invalidate the index
+		self.assertTrue( d.set( ['a', 'b', '1', 'c'], 'y'))
+		self.assertEquals( 0, d.index_stats()[ 'entries'])
+		self.assertEquals( 'y', d.get( ['a', 'b', '1', 'c']))
+
+	def test_batch(self):
+		self.assertTrue( data.try_acquire_lock( 'batch'))
+		self.assertTrue( data.update_entry_root( ['batch'], {'a': [1, 2]}))
+		self.assertEquals( data.LCK_OK, data.release_lock())
+		entries, version = data.get_batch( [['batch', 'a', '1'], ['batch', 'b']])
+		self.assertEquals( [2, None], entries)
+		self.assertEquals( data.cur_data().version, version)
+
+	def test_project(self):
+		entry = {'a': {'x': 1, 'y': [1, {'z': 2}]}, 'b': 2}
+		self.assertEquals( entry, data.project( entry))
+		self.assertEquals( ['a', 'b'], data.project( entry, keys_only=True))
+		self.assertEquals( [0, 1], data.project( entry[ 'a'][ 'y'], keys_only=True))
+		self.assertEquals( {'a': {}, 'b': 2}, data.project( entry, depth=1))
+		self.assertEquals( {'a': {'x': 1, 'y': []}, 'b': 2}, data.project( entry, depth=2))
+		self.assertEquals( {'b': 2}, data.project( entry, fields=['b', 'c']))
+		self.assertEquals( ['a'], data.project( entry, keys_only=True, fields=['a']))
+
+	def test_transaction(self):
+		base = data.cur_data().version
+		ops = [{'op': 'replace', 'path': ['trx'], 'value': {'a': 1}},
+			{'op': 'replace', 'path': ['trx', 'b'], 'value': 2}]
+		result, version = data.transaction( ops, base)
+		self.assertEquals( data.TRX_OK, result)
+		self.assertEquals( base.sequence +1, version.sequence)
+		self.assertEquals( {'a': 1, 'b': 2}, data.get_data( ['trx']))
+
+		# Outdated base is refused
+		self.assertEquals( data.TRX_CONFLICT, data.transaction( ops, base)[0])
+		# Failed operation leaves data untouched
+		ops = [{'op': 'remove', 'path': ['trx', 'a']}, {'op': 'remove', 'path': ['trx', 'c']}]
+		self.assertEquals( data.TRX_FAILED, data.transaction( ops)[0])
+		self.assertEquals( {'a': 1, 'b': 2}, data.get_data( ['trx']))
+		self.assertIsNone( data.get_lock_code())
+		# Client's lock blocks transactions
+		self.assertTrue( data.try_acquire_lock( 'trx'))
+		self.assertEquals( data.TRX_LOCKED, data.transaction( ops)[0])
+		self.assertTrue( data.abort_update())
+
+
+class RequestHandler( server.LighthouseRequestHandler):
+	"""Request handler without a connection."""
+
+	def __init__(self):
+		self._received = 0
+		self._sent = 0
+
+
+class ListHandler( logging.Handler):
+	"""Keeps messages of records handled."""
+
+	def __init__(self):
+		logging.Handler.__init__( self)
+		self.messages = []
+
+	def emit(self, record):
+		self.messages.append( record.getMessage())
+
+
+class Cycles:
+	"""Counts cycles run by the scheduler."""
+
+	def __init__(self, period):
+		self._due = None
+		self._running = False
+		self.period = period
+		self.cycles = 0
+		self.done = threading.Event()
+
+	def cycle(self):
+		self.cycles += 1
+		if self.cycles >= 3:
+			self.done.set()
+
+	def next_cycle(self):
+		return time.time() +self.period
+
+
+class Blocked( Cycles):
+	"""Cycle blocked until released, as by an instance not responding."""
+
+	def __init__(self):
+		Cycles.__init__( self, 60)
+		self.release = threading.Event()
+
+	def cycle(self):
+		Cycles.cycle( self)
+		self.release.wait( 5)
+
+
+class PeerHandler( BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Instance without /exchange, it answers POST with 501."""
+
+	protocol_version = 'HTTP/1.1'
+
+	def _answer(self, content):
+		self.server.requests.append( '%s %s'%(self.command, self.path))
+		length = int( self.headers.getheader( 'Content-Length', 0))
+		self.rfile.read( length)
+		text = helpers.encode( content)
+		self.send_response( 200)
+		self.send_header( 'Content-Type', helpers.TYPE_JSON)
+		self.send_header( 'Content-Length', str( len( text)))
+		# No thread is left waiting on a pooled connection
+		self.send_header( 'Connection', 'close')
+		self.end_headers()
+		self.wfile.write( text)
+
+	def do_GET(self):
+		self._answer( self.server.state)
+
+	def do_PUT(self):
+		self._answer( {})
+
+	def log_message(self, format, *args):
+		pass
+
+
+class ExchangePeerHandler( PeerHandler):
+	"""Instance answering /exchange."""
+
+	def do_POST(self):
+		self._answer( self.server.state)
+
+
+class PeerServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""Serves connections of the pool by threads."""
+
+	daemon_threads = True
+
+
+class TestMonitor(unittest.TestCase):
+
+	def setUp(self):
+		self.cluster_state = sync.cluster_state
+		sync.cluster_state = sync.ClusterState( 'localhost:1')
+
+	def tearDown(self):
+		sync.cluster_state = self.cluster_state
+
+	def _peer(self, handler_class, state):
+		httpd = PeerServer( ('localhost', 0), handler_class)
+		httpd.state = state
+		httpd.requests = []
+		thread = threading.Thread( target=httpd.serve_forever)
+		thread.setDaemon( True)
+		thread.start()
+		return httpd, 'localhost:%s'%httpd.server_address[1]
+
+	def test_scheduler(self):
+		scheduler = monitor.Scheduler( workers=2)
+		fast, slow = Cycles( 0.01), Cycles( 60)
+		scheduler.add( fast)
+		scheduler.add( slow)
+		self.assertTrue( fast.done.wait( 5))
+		self.assertEquals( 1, slow.cycles)
+		# Earlier time takes over, later one is ignored
+		scheduler.schedule( slow, time.time())
+		scheduler.schedule( slow, time.time() +60)
+		time.sleep( 0.2)
+		self.assertEquals( 2, slow.cycles)
+		scheduler.stop()
+
+	def test_scheduler_workers(self):
+		scheduler = monitor.Scheduler( workers=1, max_workers=4)
+		blocked = [Blocked() for i in xrange( 3)]
+		for cycles in blocked:
+			scheduler.add( cycles)
+		# Workers are added with monitors, blocked ones do not hold all
+		fast = Cycles( 0.01)
+		scheduler.add( fast)
+		self.assertTrue( fast.done.wait( 5))
+		self.assertEquals( 4, scheduler._threads)
+		scheduler.add( Cycles( 60))
+		self.assertEquals( 4, scheduler._threads)
+		for cycles in blocked:
+			cycles.release.set()
+		scheduler.stop()
+
+	def test_connect_timeout(self):
+		listener = socket.socket()
+		listener.bind( ('localhost', 0))
+		listener.listen( 1)
+		timeouts = []
+		create_connection = socket.create_connection
+		def create( address, timeout, *args):
+			timeouts.append( timeout)
+			return create_connection( address, timeout, *args)
+		socket.create_connection = create
+		try:
+			# Connecting is limited by a shorter timeout than the request
+			connection = helpers.pool._connect( 'localhost:%s'%listener.getsockname()[1])
+			self.assertEquals( [helpers.CONNECT_TIMEOUT], timeouts)
+			self.assertEquals( helpers.TIMEOUT, connection.sock.gettimeout())
+			connection.close()
+		finally:
+			socket.create_connection = create_connection
+			listener.close()
+
+	def test_gossip_targets(self):
+		cluster = sync.ClusterState( 'localhost:1')
+		cluster.instance_monitors = [monitor.Monitor( 'localhost:%s'%port) for port in xrange( 2, 8)]
+		self.assertEquals( 6, len( cluster._targets()))
+		cluster.fanout = 2
+		targets = cluster._targets()
+		self.assertEquals( 2, len( targets))
+		self.assertNotEquals( targets[0], targets[1])
+
+	def test_local_cluster(self):
+		self.assertEquals( [{'address': 'localhost:1'}], sync.ClusterState( 'localhost:1').get_members())
+		# An instance serving a Unix domain socket only is not a member
+		cluster = sync.ClusterState( None, 0)
+		cluster.update_state( [{'address': 'localhost:2'}, {'address': '/run/lighthouse.sock'}])
+		self.assertEquals( [], cluster.instance_monitors)
+		self.assertEquals( [], cluster.get_members())
+
+	def test_exchange_fallback(self):
+		version = data.cur_data().version
+		httpd, address = self._peer( PeerHandler, {'version': version.to_dict(), 'cluster': []})
+		mon = monitor.Monitor( address)
+		mon._pull()
+		# 501 of an older instance switches to PUT and GET /state
+		self.assertFalse( mon._exchange)
+		self.assertEquals( ['PUT /state', 'GET /state'], httpd.requests)
+		self.assertEquals( (version, True), mon.known_version())
+		httpd.shutdown()
+
+	def test_exchange_copy(self):
+		base = data.cur_data()
+		new = data.Data.copy( base)
+		self.assertTrue( new.set( ['exchanged'], 1))
+		copy = {
+			'version': {'sequence': base.version.sequence +1, 'checksum': new.get_checksum()},
+			'base': base.version.to_dict(),
+			'patch': data.diff( base, new),
+		}
+		httpd, address = self._peer( ExchangePeerHandler, {'version': copy[ 'version'], 'cluster': [], 'copy': copy})
+		mon = monitor.Monitor( address)
+		mon._pull()
+		# Changes in the response are applied without another request
+		self.assertEquals( ['POST /exchange'], httpd.requests)
+		self.assertEquals( 1, data.get_data( ['exchanged']))
+		self.assertEquals( data.cur_data().version, mon.known_version()[0])
+		httpd.shutdown()
+
+	def test_failure_detector(self):
+		detector = monitor.FailureDetector()
+		self.assertEquals( None, detector.phi( 0))
+		for i in xrange( 20):
+			detector.heartbeat( i *0.5, 0.5)
+		self.assertTrue( detector.phi( 10.0) < 1)
+		self.assertTrue( detector.phi( 11.0) < monitor.PHI_THRESHOLD)
+		self.assertTrue( detector.phi( 15.0) > monitor.PHI_THRESHOLD)
+		self.assertTrue( detector.phi( 1000.0) > detector.phi( 15.0))
+
+	def test_failure_detector_relax(self):
+		# Pings of a stable instance relax, each one in time
+		detector = monitor.FailureDetector()
+		now, interval = 0.0, monitor.PING_PERIOD
+		for i in xrange( 20):
+			detector.heartbeat( now, interval)
+			now += interval +0.01
+			self.assertTrue( detector.phi( now) < 1)
+			interval = min( interval *monitor.PING_RELAX, monitor.PING_PERIOD_STABLE)
+		self.assertEquals( monitor.PING_PERIOD_STABLE, interval)
+		# Silence is suspicious relative to the current period
+		detector.heartbeat( now, interval)
+		self.assertTrue( detector.phi( now +interval +2) < monitor.PHI_THRESHOLD)
+		self.assertTrue( detector.phi( now +2 *interval) > monitor.PHI_THRESHOLD)
+		# Back at the base period, the learnt delays still apply
+		detector.heartbeat( now +interval, monitor.PING_PERIOD)
+		self.assertTrue( detector.phi( now +interval +monitor.PING_PERIOD) < 1)
+
+	def test_ping_period(self):
+		mon = monitor.Monitor( 'localhost:2')
+		for i in xrange( 10):
+			mon._touch_unreachable()
+		self.assertEquals( monitor.PING_PERIOD_BACKOFF, mon._interval)
+		self.assertFalse( mon.to_dict()[ 'reachable'])
+		# Same version as ours relaxes pings, a change resets them
+		version = data.cur_data().version
+		mon._touch_last_reachable( version)
+		self.assertEquals( monitor.PING_PERIOD, mon._interval)
+		mon._touch_last_reachable( version)
+		self.assertEquals( monitor.PING_PERIOD *monitor.PING_RELAX, mon._interval)
+		for i in xrange( 10):
+			mon._touch_last_reachable( version)
+		self.assertEquals( monitor.PING_PERIOD_STABLE, mon._interval)
+		self.assertTrue( mon.to_dict()[ 'reachable'])
+		mon._touch_last_reachable( data.DataVersion( version.sequence +1))
+		self.assertEquals( monitor.PING_PERIOD, mon._interval)
+
+
+class OkHandler( BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Answers every request on a persistent connection."""
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		self.send_response( 200)
+		self.send_header( 'Content-Length', '2')
+		self.end_headers()
+		self.wfile.write( 'ok')
+
+	def log_message(self, format, *args):
+		pass
+
+
+class TestHelpers(unittest.TestCase):
+
+	def test_pool(self):
+		httpd = BaseHTTPServer.HTTPServer( ('localhost', 0), OkHandler)
+		address = 'localhost:%s'%httpd.server_address[1]
+		thread = threading.Thread( target=httpd.serve_forever)
+		thread.setDaemon( True)
+		thread.start()
+
+		pool = helpers.ConnectionPool( size=1, idle_timeout=60)
+		for i in xrange( 3):
+			status, _, content = pool.request( address, 'GET', '/')
+			self.assertEquals( (200, 'ok'), (status, content))
+		state = pool.get_state()
+		self.assertEquals( (1, 2), (state[ 'created'], state[ 'reused']))
+		self.assertEquals( {address: 1}, state[ 'idle'])
+		# Idle connections are closed after timeout
+		pool.idle_timeout = 0
+		time.sleep( 0.01)
+		self.assertEquals( {}, pool.get_state()[ 'idle'])
+		self.assertEquals( 1, pool.get_state()[ 'evicted'])
+		httpd.shutdown()
+
+
+	def test_negotiate_type(self):
+		self.assertEquals( helpers.TYPE_JSON, helpers.negotiate_type( None))
+		self.assertEquals( helpers.TYPE_JSON, helpers.negotiate_type( '*/*'))
+		self.assertEquals( helpers.TYPE_JSON, helpers.negotiate_type( 'text/html, application/json'))
+		if helpers.msgpack is None:
+			self.assertEquals( helpers.TYPE_JSON, helpers.negotiate_type( helpers.TYPE_MSGPACK))
+			return
+		self.assertEquals( helpers.TYPE_MSGPACK, helpers.negotiate_type( helpers.TYPE_MSGPACK))
+		self.assertEquals( helpers.TYPE_MSGPACK, helpers.negotiate_type( 'application/json;q=0.5, application/x-msgpack'))
+		self.assertEquals( helpers.TYPE_JSON, helpers.negotiate_type( 'application/x-msgpack;q=0.5, */*'))
+		self.assertEquals( helpers.TYPE_JSON, helpers.negotiate_type( 'application/x-msgpack;q=0'))
+
+	def test_parse_qualities(self):
+		self.assertEquals( {}, helpers.parse_qualities( None))
+		self.assertEquals( {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0},
+				helpers.parse_qualities( 'GZIP, deflate; q=0.5, br;q=x'))
+		self.assertEquals( 'deflate', helpers.negotiate_encoding( 'gzip;q=0, deflate'))
+		self.assertIsNone( helpers.negotiate_encoding( None))
+
+	def test_encode(self):
+		content = {'version': {'sequence': 1, 'checksum': 'ab'}, u'd\xe1ta': [1, None, 2.5]}
+		encoded = helpers.encode( content)
+		self.assertEquals( '{"d\\u00e1ta":[1,null,2.5],"version":{"checksum":"ab","sequence":1}}', encoded)
+		self.assertEquals( content, helpers.decode( encoded))
+		self.assertEquals( content, helpers.decode( helpers.encode( content, pretty=True)))
+		self.assertIn( '\n', helpers.encode( content, pretty=True))
+		self.assertRaises( ValueError, helpers.decode, '{"a"')
+
+	@unittest.skipIf( helpers.msgpack is None, 'msgpack is not available')
+	def test_encode_msgpack(self):
+		content = {'version': {'sequence': 1, 'checksum': 'ab'}, u'd\xe1ta': [1, None, 2.5]}
+		encoded = helpers.encode( content, helpers.TYPE_MSGPACK)
+		self.assertEquals( content, helpers.decode( encoded, helpers.TYPE_MSGPACK))
+		# Strings are packed as text, not binary
+		self.assertEquals( '\x81\xa1a\xa1b', helpers.encode( {'a': 'b'}, helpers.TYPE_MSGPACK))
+		self.assertRaises( ValueError, helpers.decode, '\xc1', helpers.TYPE_MSGPACK)
+
+
+class TestServer(unittest.TestCase):
+
+	def _handler(self, headers, content):
+		handler = RequestHandler()
+		handler.headers = mimetools.Message( StringIO.StringIO( headers +'\r\n'))
+		handler.rfile = StringIO.StringIO( content)
+		handler.max_body = 100
+		return handler
+
+	def _request(self, command, path, headers='', content=''):
+		"""Handles the request given, returns status, headers and content
+		of the response."""
+		if content:
+			headers += 'Content-Length: %s\r\n'%len( content)
+		handler = RequestHandler()
+		handler.rfile = StringIO.StringIO( '%s %s HTTP/1.1\r\n%s\r\n%s'%(command, path, headers, content))
+		handler.wfile = StringIO.StringIO()
+		handler.client_address = ('127.0.0.1', 0)
+		handler.handle_one_request()
+		head, _, content = handler.wfile.getvalue().partition( '\r\n\r\n')
+		lines = head.split( '\r\n')
+		response_headers = mimetools.Message( StringIO.StringIO( '\r\n'.join( lines[1:]) +'\r\n\r\n'))
+		return int( lines[0].split()[1]), response_headers, content
+
+	def _commit(self, path, value):
+		self.assertTrue( data.try_acquire_lock( 'test'))
+		self.assertTrue( data.update_entry_root( path, value))
+		self.assertEquals( data.LCK_OK, data.release_lock())
+
+	def test_read_input(self):
+		handler = self._handler( 'Content-Length: 5\r\n', 'abcdefgh')
+		self.assertEquals( 'abcde', handler._read_input())
+		handler = self._handler( 'Transfer-Encoding: chunked\r\n', '3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n')
+		self.assertEquals( 'abcde', handler._read_input())
+		handler = self._handler( 'Content-Length: 10\r\n', 'abc')
+		self.assertIsNone( handler._read_input())
+
+		# Too large content is refused before it is read
+		handler = self._handler( 'Content-Length: 101\r\n', '')
+		self.assertRaises( server.RequestBodyError, handler._read_input)
+		handler = self._handler( 'Transfer-Encoding: chunked\r\n', '65\r\n')
+		self.assertRaises( server.RequestBodyError, handler._read_input)
+		# Limit applies to decompressed content as well
+		content = helpers.compress( 'x'*101, 'gzip')
+		handler = self._handler( 'Content-Length: %d\r\nContent-Encoding: gzip\r\n'%len( content), content)
+		self.assertRaises( server.RequestBodyError, handler._read_input)
+		content = helpers.compress( 'x'*100, 'gzip')
+		handler = self._handler( 'Content-Length: %d\r\nContent-Encoding: gzip\r\n'%len( content), content)
+		self.assertEquals( 'x'*100, handler._read_input())
+
+	def test_read_timeout(self):
+		listener = socket.socket()
+		listener.bind( ('localhost', 0))
+		listener.listen( 1)
+		other = socket.create_connection( listener.getsockname())
+		sock, _ = listener.accept()
+		listener.close()
+		handler = self._handler( 'Content-Length: 6\r\n', '')
+		handler.connection = sock
+		handler.rfile = sock.makefile( 'rb', -1)
+		handler.timeout = 5
+		def trickle():
+			for c in 'abcdef':
+				other.sendall( c)
+				time.sleep( 0.2)
+		thread = threading.Thread( target=trickle)
+		thread.start()
+		body_timeout = server.BODY_TIMEOUT
+		server.BODY_TIMEOUT = 0.3
+		try:
+			# Slow content is refused by the deadline, not once it is complete
+			started = time.time()
+			try:
+				handler._read_input()
+				self.fail( 'Slow content accepted')
+			except server.RequestBodyError, e:
+				self.assertEquals( 408, e.status)
+			self.assertTrue( time.time() -started < 0.6)
+		finally:
+			server.BODY_TIMEOUT = body_timeout
+			thread.join()
+			sock.close()
+			other.close()
+
+	def test_etag(self):
+		self._commit( ['etag'], {'a': {'x': 1}, 'b': 2})
+		status, headers, content = self._request( 'GET', '/data/etag/a')
+		self.assertEquals( 200, status)
+		self.assertEquals( {'x': 1}, helpers.load_json( content))
+		etag = headers[ 'ETag']
+
+		# Matching tags are not modified, weak and any tag included
+		for none_match in (etag, 'W/'+etag, '"x", '+etag, '*'):
+			status, headers, content = self._request( 'GET', '/data/etag/a', 'If-None-Match: %s\r\n'%none_match)
+			self.assertEquals( 304, status)
+			self.assertEquals( etag, headers[ 'ETag'])
+			self.assertEquals( '', content)
+		status, _, _ = self._request( 'GET', '/data/etag/a', 'If-None-Match: "x"\r\n')
+		self.assertEquals( 200, status)
+
+		# HEAD has headers of GET without content
+		status, headers, content = self._request( 'HEAD', '/data/etag/a')
+		self.assertEquals( 200, status)
+		self.assertEquals( etag, headers[ 'ETag'])
+		self.assertEquals( '', content)
+
+		# The tag changes only with the subtree
+		parent = self._request( 'GET', '/data/etag')[1][ 'ETag']
+		self._commit( ['etag', 'b'], 3)
+		self.assertEquals( etag, self._request( 'GET', '/data/etag/a')[1][ 'ETag'])
+		self.assertNotEquals( parent, self._request( 'GET', '/data/etag')[1][ 'ETag'])
+		self._commit( ['etag', 'a', 'x'], 2)
+		self.assertNotEquals( etag, self._request( 'GET', '/data/etag/a')[1][ 'ETag'])
+
+		# Representations have their own tags
+		etag = self._request( 'GET', '/data/etag/a')[1][ 'ETag']
+		status, headers, _ = self._request( 'GET', '/data/etag/a', 'Accept-Encoding: gzip\r\n')
+		self.assertNotEquals( etag, headers[ 'ETag'])
+		status, _, _ = self._request( 'GET', '/data/etag/a', 'Accept-Encoding: gzip\r\nIf-None-Match: %s\r\n'%etag)
+		self.assertEquals( 200, status)
+		status, headers, _ = self._request( 'GET', '/data/etag/a', 'If-None-Match: %s\r\n'%etag)
+		self.assertEquals( 304, status)
+		self.assertEquals( 'Accept, Accept-Encoding', headers[ 'Vary'])
+
+	def test_wait_timeout(self):
+		self._commit( ['timeout'], 1)
+		sequence = data.cur_data().version.sequence
+		for timeout in ('nan', 'inf', '-5', '0', 'x'):
+			status, _, _ = self._request( 'GET', '/data/timeout?wait=%s&timeout=%s'%( sequence, timeout))
+			self.assertEquals( 400, status)
+		started = time.time()
+		status, headers, _ = self._request( 'GET', '/data/timeout?wait=%s&timeout=0.1'%sequence)
+		self.assertEquals( 304, status)
+		self.assertTrue( time.time() -started >= 0.1)
+		self.assertEquals( str( sequence), headers[ 'X-Lighthouse-Sequence'])
+
+	@unittest.skipIf( helpers.msgpack is None, 'msgpack is not available')
+	def test_head_msgpack(self):
+		self._commit( ['head'], {'a': 1})
+		accept = 'Accept: %s\r\n'%helpers.TYPE_MSGPACK
+		status, headers, content = self._request( 'HEAD', '/data/head', accept)
+		self.assertEquals( 200, status)
+		self.assertEquals( helpers.TYPE_MSGPACK, headers[ 'Content-Type'])
+		self.assertEquals( '', content)
+		self.assertEquals( headers[ 'ETag'], self._request( 'GET', '/data/head', accept)[1][ 'ETag'])
+		self.assertNotEquals( headers[ 'ETag'], self._request( 'GET', '/data/head')[1][ 'ETag'])
+
+	def test_accepted_encoding(self):
+		def accepted( value):
+			return self._handler( 'Accept-Encoding: %s\r\n'%value, '')._accepted_encoding()
+		self.assertIsNone( self._handler( '', '')._accepted_encoding())
+		self.assertEquals( 'gzip', accepted( 'deflate, gzip'))
+		self.assertEquals( 'deflate', accepted( 'gzip;q=0, deflate'))
+		self.assertEquals( 'deflate', accepted( 'GZIP; q=0.0, Deflate;q=0.5'))
+		self.assertIsNone( accepted( 'gzip;q=0, deflate;q=x'))
+		self.assertIsNone( accepted( 'identity, br'))
+
+	def test_compression(self):
+		self._commit( ['compression'], {'small': 'x', 'large': 'x'*helpers.COMPRESS_MIN})
+		# Small responses are not compressed
+		status, headers, content = self._request( 'GET', '/data/compression/small', 'Accept-Encoding: gzip\r\n')
+		self.assertIsNone( headers.getheader( 'Content-Encoding'))
+		self.assertEquals( '"x"', content)
+		status, headers, content = self._request( 'GET', '/data/compression/large', 'Accept-Encoding: deflate\r\n')
+		self.assertEquals( 'deflate', headers[ 'Content-Encoding'])
+		self.assertEquals( 'Accept, Accept-Encoding', headers[ 'Vary'])
+		self.assertEquals( '"%s"'%('x'*helpers.COMPRESS_MIN), helpers.decompress( content, 'deflate'))
+
+	def test_body_cache(self):
+		self._commit( ['cache'], {'a': 1})
+		metrics.reset()
+		first = self._request( 'GET', '/data/cache')[2]
+		# Unchanged content is serialized once for each representation
+		self.assertEquals( first, self._request( 'GET', '/data/cache')[2])
+		self.assertIn( 'lighthouse_serialization_duration_seconds_count 1\n', metrics.render())
+		self._request( 'GET', '/data/cache?pretty')
+		self.assertIn( 'lighthouse_serialization_duration_seconds_count 2\n', metrics.render())
+
+		# The least recently used bodies are dropped over limits
+		cache = server.BodyCache( size=2, size_bytes=10)
+		cache.put( 'a', ('aaa', None))
+		cache.put( 'b', ('bbb', None))
+		self.assertIsNotNone( cache.get( 'a'))
+		cache.put( 'c', ('ccc', None))
+		self.assertIsNone( cache.get( 'b'))
+		self.assertEquals( ('aaa', None), cache.get( 'a'))
+		cache.put( 'd', ('dddddd', None))
+		self.assertIsNone( cache.get( 'c'))
+		self.assertEquals( ('aaa', None), cache.get( 'a'))
+		self.assertEquals( ('dddddd', None), cache.get( 'd'))
+		cache.put( 'e', ('e'*11, None))
+		self.assertIsNone( cache.get( 'e'))
+
+	def test_content_type(self):
+		self._commit( ['types'], {'a': [1, 2]})
+		status, headers, content = self._request( 'GET', '/data/types?pretty')
+		self.assertEquals( helpers.TYPE_JSON, headers[ 'Content-Type'])
+		self.assertIn( '\n', content)
+		self.assertEquals( {'a': [1, 2]}, helpers.decode( content))
+		if helpers.msgpack is None:
+			return
+		status, headers, content = self._request( 'GET', '/data/types', 'Accept: %s\r\n'%helpers.TYPE_MSGPACK)
+		self.assertEquals( helpers.TYPE_MSGPACK, headers[ 'Content-Type'])
+		self.assertEquals( {'a': [1, 2]}, helpers.decode( content, helpers.TYPE_MSGPACK))
+
+	def test_exchange(self):
+		cluster_state = sync.cluster_state
+		sync.cluster_state = sync.ClusterState( 'localhost:1')
+		try:
+			self._commit( ['exchange'], 1)
+			base = data.cur_data().version
+			self._commit( ['exchange'], 2)
+			current = data.cur_data().version
+			def exchange( version):
+				status, _, content = self._request( 'POST', '/exchange', '',
+						helpers.encode( {'version': version.to_dict(), 'cluster': []}))
+				self.assertEquals( 200, status)
+				response = helpers.decode( content)
+				self.assertEquals( current.to_dict(), response[ 'version'])
+				self.assertIn( {'address': 'localhost:1'}, response[ 'cluster'])
+				return response.get( 'copy')
+
+			# Nothing to send to an instance up to date
+			self.assertIsNone( exchange( current))
+			# Changes since a known version, complete data otherwise
+			copy = exchange( base)
+			self.assertEquals( [{'op': 'replace', 'path': ['exchange'], 'value': 2}], copy[ 'patch'])
+			copy = exchange( data.DataVersion( 0, 'x'))
+			self.assertEquals( 2, copy[ 'data'][ 'exchange'])
+			self.assertEquals( 400, self._request( 'POST', '/exchange', '', '{"cluster": []}')[0])
+		finally:
+			sync.cluster_state = cluster_state
+
+	def test_admission(self):
+		admission = server.Admission( {server.ROUTE_READ: 1, server.ROUTE_UPDATE: 2})
+		self.assertTrue( admission.enter( server.ROUTE_READ))
+		self.assertFalse( admission.enter( server.ROUTE_READ))
+		self.assertTrue( admission.enter( server.ROUTE_UPDATE))
+		state = admission.get_state()
+		self.assertEquals( {'active': 1, 'limit': 1, 'rejected': 1}, state[ server.ROUTE_READ])
+		self.assertEquals( {'active': 1, 'limit': 2, 'rejected': 0}, state[ server.ROUTE_UPDATE])
+		admission.leave( server.ROUTE_READ)
+		self.assertTrue( admission.enter( server.ROUTE_READ))
+
+	def test_metrics(self):
+		metrics.reset()
+		metrics.inc( 'lighthouse_requests_total', ('/data', 'GET', 200))
+		metrics.inc( 'lighthouse_requests_total', ('/data', 'GET', 200))
+		metrics.observe( 'lighthouse_snapshot_duration_seconds', 0.003)
+		text = metrics.render()
+		self.assertIn( 'lighthouse_requests_total{route="/data",method="GET",status="200"} 2\n', text)
+		self.assertIn( 'lighthouse_snapshot_duration_seconds_bucket{le="0.0025"} 0\n', text)
+		self.assertIn( 'lighthouse_snapshot_duration_seconds_bucket{le="0.005"} 1\n', text)
+		self.assertIn( 'lighthouse_snapshot_duration_seconds_bucket{le="+Inf"} 1\n', text)
+		self.assertIn( 'lighthouse_snapshot_duration_seconds_count 1\n', text)
+		self.assertIn( '# TYPE lighthouse_snapshot_duration_seconds histogram\n', text)
+
+		# Unknown routes and methods do not make new series
+		metrics.reset()
+		for command in ('FOO', 'BAR'):
+			status, _, _ = self._request( command, '/unknown/%s'%command)
+			self.assertEquals( 501, status)
+		text = metrics.render()
+		self.assertIn( 'lighthouse_requests_total{route="other",method="other",status="501"} 2\n', text)
+		self.assertNotIn( 'FOO', text)
+
+	def test_logqueue(self):
+		self.assertEquals( 'abc', str( logqueue.Payload( 'abc')))
+		self.assertEquals( 'ab... (3 characters)', str( logqueue.Payload( u'abc', 2)))
+		target = ListHandler()
+		handler = logqueue.QueueHandler( target)
+		logger = logging.getLogger( 'test_logqueue')
+		logger.propagate = False
+		logger.addHandler( handler)
+		logger.warning( 'Content %s', logqueue.Payload( 'x'*10, 4))
+		handler.flush()
+		self.assertEquals( ['Content xxxx... (10 characters)'], target.messages)
+
+	def test_bind_unix(self):
+		path = os.path.join( tempfile.mkdtemp(), 'lighthouse.sock')
+		sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind_unix( sock, path, 0600)
+		self.assertEquals( 0600, stat.S_IMODE( os.stat( path).st_mode))
+		# Socket in use is kept
+		sock.listen( 1)
+		other = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM)
+		self.assertRaises( socket.error, server.bind_unix, other, path, 0600)
+		# Stale socket is replaced
+		sock.close()
+		server.bind_unix( other, path, 0660)
+		self.assertEquals( 0660, stat.S_IMODE( os.stat( path).st_mode))
+		other.close()
+		os.unlink( path)
+		os.rmdir( os.path.dirname( path))
+
+	def test_eventloop_error(self):
+		httpd = eventloop.EventLoopServer( ('localhost', 0))
+		address = httpd.socket.getsockname()
+		def request():
+			client = socket.create_connection( address)
+			client.settimeout( 2)
+			client.sendall( 'GET /data HTTP/1.1\r\n\r\n')
+			for i in xrange( 10):
+				httpd.poll_once( 0.01)
+			return client.recv( 4096)
+
+		class FailingHandler( eventloop.BufferedRequestHandler):
+			def handle(self):
+				raise ValueError( 'Failing handler')
+		handler_class = eventloop.BufferedRequestHandler
+		eventloop.BufferedRequestHandler = FailingHandler
+		try:
+			# Only the connection of the failed request is closed
+			self.assertEquals( '', request())
+		finally:
+			eventloop.BufferedRequestHandler = handler_class
+		self.assertIn( ' 200 ', request())
+		httpd.close()
+
+	def test_eventloop_admission(self):
+		httpd = eventloop.EventLoopServer( ('localhost', 0))
+		address = httpd.socket.getsockname()
+		def loop():
+			for i in xrange( 10):
+				httpd.poll_once( 0.01)
+				httpd._wake_parked()
+		clients = []
+		def wait( sequence):
+			client = socket.create_connection( address)
+			clients.append( client)
+			client.settimeout( 2)
+			client.sendall( 'GET /data?wait=%s&timeout=10 HTTP/1.1\r\n\r\n'%sequence)
+			loop()
+			return client
+		limit = server.admission.limits[ server.ROUTE_WAIT]
+		server.admission.limits[ server.ROUTE_WAIT] = 1
+		try:
+			# A parked request stays admitted, others are refused
+			sequence = data.cur_data().version.sequence
+			parked = wait( sequence)
+			self.assertEquals( 1, server.admission.get_state()[ server.ROUTE_WAIT][ 'active'])
+			refused = wait( sequence)
+			self.assertIn( ' 503 ', refused.recv( 4096))
+			# The admission is left once the request is answered
+			self._commit( ['admission'], 1)
+			loop()
+			self.assertIn( ' 200 ', parked.recv( 4096))
+			self.assertEquals( 0, server.admission.get_state()[ server.ROUTE_WAIT][ 'active'])
+
+			# A parked client closing is noticed before the deadline
+			parked = wait( data.cur_data().version.sequence)
+			self.assertEquals( 1, httpd.queue_depth())
+			parked.close()
+			loop()
+			self.assertEquals( 0, httpd.queue_depth())
+			self.assertEquals( 0, server.admission.get_state()[ server.ROUTE_WAIT][ 'active'])
+		finally:
+			server.admission.limits[ server.ROUTE_WAIT] = limit
+			for client in clients:
+				client.close()
+			httpd.close()
+			loop()
+
+	def test_eventloop_idle(self):
+		httpd = eventloop.EventLoopServer( ('localhost', 0), keepalive_timeout=0.2)
+		address = httpd.socket.getsockname()
+		def loop():
+			for i in xrange( 10):
+				httpd.poll_once( 0.01)
+		self._commit( ['idle'], 1)
+		body_timeout = server.BODY_TIMEOUT
+		server.BODY_TIMEOUT = 0.2
+		try:
+			idle = socket.create_connection( address)
+			slow = socket.create_connection( address)
+			active = socket.create_connection( address)
+			for client in (idle, slow, active):
+				client.settimeout( 2)
+			slow.sendall( 'GET /da')
+			loop()
+			time.sleep( 0.3)
+			active.sendall( 'GET /data/idle HTTP/1.1\r\n\r\n')
+			loop()
+			self.assertIn( ' 200 ', active.recv( 4096))
+			# Only connections idle or reading for too long are closed
+			httpd._close_idle()
+			loop()
+			self.assertEquals( '', idle.recv( 4096))
+			self.assertIn( ' 408 ', slow.recv( 4096))
+			active.sendall( 'GET /data/idle HTTP/1.1\r\n\r\n')
+			loop()
+			self.assertIn( ' 200 ', active.recv( 4096))
+		finally:
+			server.BODY_TIMEOUT = body_timeout
+			for client in (idle, slow, active):
+				client.close()
+			httpd.close()
+			loop()
+
+	def test_workers(self):
+		class OneWorker( server.ThreadedHTTPServer):
+			workers = 1
+		httpd = OneWorker( ('localhost', 0), server.LighthouseRequestHandler)
+		httpd.start_workers()
+		thread = threading.Thread( target=httpd.serve_forever)
+		thread.setDaemon( True)
+		thread.start()
+
+		# Idle connections do not take the only worker
+		idle = [socket.create_connection( httpd.server_address) for i in xrange( 2)]
+		idle[1].sendall( 'GET /data HTTP/1.1\r\n\r\n')
+		self.assertIn( ' 200 ', idle[1].recv( 4096))
+		for i in xrange( 2):
+			connection = httplib.HTTPConnection( 'localhost', httpd.server_address[1], timeout=2)
+			connection.request( 'GET', '/data')
+			self.assertEquals( 200, connection.getresponse().status)
+			connection.close()
+		for sock in idle:
+			sock.close()
+
+		# A slow request holds the worker only until the header deadline
+		header_timeout = server.HEADER_TIMEOUT
+		server.HEADER_TIMEOUT = 0.3
+		try:
+			slow = socket.create_connection( httpd.server_address)
+			slow.sendall( 'GET /da')
+			time.sleep( 0.1)
+			started = time.time()
+			connection = httplib.HTTPConnection( 'localhost', httpd.server_address[1], timeout=2)
+			connection.request( 'GET', '/data')
+			self.assertEquals( 200, connection.getresponse().status)
+			self.assertTrue( time.time() -started < 1)
+			connection.close()
+			slow.settimeout( 2)
+			self.assertEquals( '', slow.recv( 4096))
+			slow.close()
+		finally:
+			server.HEADER_TIMEOUT = header_timeout
+		httpd.shutdown()
+		httpd.server_close()
+
+	def test_queue_full(self):
+		class OneWorker( server.ThreadedHTTPServer):
+			workers = 1
+			queue_size = 1
+		httpd = OneWorker( ('localhost', 0), server.LighthouseRequestHandler)
+		httpd.start_workers()
+		thread = threading.Thread( target=httpd.serve_forever)
+		thread.setDaemon( True)
+		thread.start()
+		def connect():
+			return httplib.HTTPConnection( 'localhost', httpd.server_address[1], timeout=5)
+
+		# A connection failing to be watched is closed, the poller goes on
+		broken = socket.socket()
+		broken.close()
+		httpd._poller.add( httpd, broken, ('127.0.0.1', 0))
+
+		# The worker waits for a change, one request waits in the queue
+		sequence = data.cur_data().version.sequence
+		waiting = connect()
+		waiting.request( 'GET', '/data?wait=%s&timeout=0.5'%sequence)
+		time.sleep( 0.1)
+		queued = connect()
+		queued.request( 'GET', '/data')
+		time.sleep( 0.1)
+		# The next one is refused at once
+		refused = connect()
+		refused.request( 'GET', '/data')
+		response = refused.getresponse()
+		self.assertEquals( 503, response.status)
+		self.assertEquals( '1', response.getheader( 'Retry-After'))
+		self.assertEquals( 1, httpd.refused_requests())
+		self.assertEquals( 304, waiting.getresponse().status)
+		self.assertEquals( 200, queued.getresponse().status)
+		for connection in (waiting, queued, refused):
+			connection.close()
+		httpd.shutdown()
+		httpd.server_close()
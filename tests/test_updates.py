@@ -213,8 +213,8 @@ block( 'Test push/pull copy and state')
 #
 
 # Read the configuration
-C = '{"data":{"c":"","d":3,"e":{"q":"w"}},"version":{"checksum":"9635212a5b654e8efff3e81475c1aa69","sequence":2}}'
-S = '{"cluster":[],"version":{"checksum":"9635212a5b654e8efff3e81475c1aa69","sequence":2}}'
+C = '{"data":{"c":"","d":3,"e":{"q":"w"}},"version":{"checksum":"724d7fe8fcd74a83a685091d8cf4a55b","sequence":2}}'
+S = '{"cluster":[],"version":{"checksum":"724d7fe8fcd74a83a685091d8cf4a55b","sequence":2}}'
 get( '/copy/', 200, C)
 get( '/state/', 200, S)
 # Put copy with the same version - should be ignored
@@ -222,8 +222,8 @@ put( '/copy/', C, 201)
 get( '/copy/', 200, C)
 get( '/state/', 200, S)
 # Put copy with newer sequence - should be accepted
-C = '{"data":{"c":"","d":3,"e":{"q":"w"}},"version":{"checksum":"9635212a5b654e8efff3e81475c1aa69","sequence":6}}'
-S = '{"cluster":[],"version":{"checksum":"9635212a5b654e8efff3e81475c1aa69","sequence":6}}'
+C = '{"data":{"c":"","d":3,"e":{"q":"w"}},"version":{"checksum":"724d7fe8fcd74a83a685091d8cf4a55b","sequence":6}}'
+S = '{"cluster":[],"version":{"checksum":"724d7fe8fcd74a83a685091d8cf4a55b","sequence":6}}'
 put( '/copy/', C, 201)
 get( '/copy/', 200, C)
 get( '/state/', 200, S)
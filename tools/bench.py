@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+"""Compares server engines on the same workload.
+
+Starts a Lighthouse instance for each engine, loads sample data, opens idle
+persistent connections and then runs clients reading data over persistent
+connections. Prints throughput and latency percentiles for every engine.
+
+Usage:
+	bench.py [--requests=N] [--clients=N] [--idle=N] [--path=/data/...]
+
+"""
+
+import getopt
+import httplib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ENGINES = ['threaded', 'eventloop']
+MAIN = os.path.join( os.path.dirname( os.path.abspath( __file__)), '..', 'lighthouse', 'main.py')
+HOST = 'localhost'
+PORT = 8101
+
+SAMPLE = {
+	'file': '/var/log/apache2/access.log',
+	'size': 1024,
+	'providers': dict( ('p%s'%i, ['192.168.%s.%s'%(i, j) for j in range( 10)]) for i in range( 100)),
+}
+
+
+def request( address, method, path, body=None):
+	connection = httplib.HTTPConnection( address)
+	connection.request( method, path, body)
+	response = connection.getresponse()
+	response.read()
+	connection.close()
+	return response.status
+
+
+def start_instance( engine, port, data_dir):
+	address = '%s:%s'%(HOST, port)
+	# Both engines run with their defaults, each with its own data directory
+	process = subprocess.Popen( [sys.executable, MAIN, '--bootstrap',
+			'--bind=%s'%address, '--engine=%s'%engine, '--data.d=%s'%data_dir],
+			stdout=open( os.devnull, 'w'), stderr=subprocess.STDOUT)
+	for _ in range( 50):
+		try:
+			request( address, 'GET', '/lock')
+			break
+		except socket.error:
+			time.sleep( 0.1)
+	# Load sample data
+	request( address, 'PUT', '/lock', 'bench')
+	request( address, 'PUT', '/update/bench', json.dumps( SAMPLE))
+	request( address, 'PUT', '/lock/bench', '')
+	return process, address
+
+
+def client( address, path, count, latencies):
+	connection = httplib.HTTPConnection( address)
+	for _ in xrange( count):
+		start = time.time()
+		connection.request( 'GET', path)
+		response = connection.getresponse()
+		response.read()
+		latencies.append( time.time() -start)
+	connection.close()
+
+
+def run( engine, port, requests, clients, idle, path):
+	data_dir = tempfile.mkdtemp( prefix='lighthouse-bench-%s-'%engine)
+	process, address = start_instance( engine, port, data_dir)
+	try:
+		# Idle persistent connections
+		idle_sockets = []
+		for _ in xrange( idle):
+			idle_sockets.append( socket.create_connection( (HOST, port)))
+
+		latencies = []
+		threads = [threading.Thread( target=client, args=(address, path, requests, latencies))
+				for _ in xrange( clients)]
+		start = time.time()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		elapsed = time.time() -start
+
+		for sock in idle_sockets:
+			sock.close()
+	finally:
+		process.terminate()
+		process.wait()
+		shutil.rmtree( data_dir, ignore_errors=True)
+
+	latencies.sort()
+	def percentile( p):
+		return latencies[ min( len( latencies) -1, int( len( latencies) *p))] *1000
+	print '%-10s %8.0f req/s  p50 %6.2f ms  p99 %6.2f ms  max %6.2f ms'%(
+			engine, len( latencies) /elapsed, percentile( 0.5), percentile( 0.99), latencies[-1] *1000)
+
+
+def main():
+	optlist, args = getopt.gnu_getopt( sys.argv[1:], '', 'requests= clients= idle= path='.split())
+	requests = 1000
+	clients = 8
+	idle = 100
+	path = '/data/providers/p1'
+	for name, value in optlist:
+		if name == '--requests':
+			requests = int( value)
+		if name == '--clients':
+			clients = int( value)
+		if name == '--idle':
+			idle = int( value)
+		if name == '--path':
+			path = value
+
+	print '%s clients x %s requests of %s, %s idle connections'%(clients, requests, path, idle)
+	for i, engine in enumerate( ENGINES):
+		run( engine, PORT +i, requests, clients, idle, path)
+
+
+if __name__ == '__main__':
+	main()